@@ -52,9 +52,12 @@ setup(
     install_requires=[
         "setuptools",
         "numpy",
-        "opencv-python-headless",
     ],
     extras_require={
+        # Without OpenCV we use the NumPy corner detector.
+        "opencv": [
+            "opencv-python-headless",
+        ],
         "test": [
             "plone.app.testing",
             # Plone KGS does not use this version, because it would break
@@ -63,6 +66,7 @@ setup(
             "plone.testing>=5.0.0",
             "plone.app.contenttypes",
             "plone.app.robotframework[debug]",
+            "opencv-python-headless",
         ],
     },
     entry_points="""
@@ -70,5 +74,11 @@ setup(
     target = plone
     [console_scripts]
     update_locale = experimental.focalpoints.locales.update:update_locale
+    focalpoints-loadtest = experimental.focalpoints.loadtest:main
+    focalpoints-benchmark = experimental.focalpoints.benchmark:main
+    focalpoints-importtime = experimental.focalpoints.startup:main
+    focalpoints-memory = experimental.focalpoints.memory:main
+    focalpoints-transfer = experimental.focalpoints.transfer:main
+    focalpoints-replay = experimental.focalpoints.replay:main
     """,
 )
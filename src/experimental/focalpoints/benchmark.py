@@ -0,0 +1,214 @@
+"""Accuracy versus speed of focal point detector settings.
+
+For every detector configuration we run detection on a set of images
+where we know where the subjects are, and report:
+
+- found: percentage of images where any focal point was found,
+- distance: distance between the detected and the true focal point,
+  as percentage of the image diagonal,
+- kept: percentage of the subjects that is kept when cropping with
+  CropFocalPointsTransformer, averaged over a few aspect ratios,
+- worst: the lowest kept percentage of all images and ratios,
+- ms/MP: milliseconds of detection per megapixel of the original.
+
+The true focal point is the area-weighted center of the subjects.
+When nothing is found, we crop around the center of the image,
+like standard Plone does.
+
+The images are synthetic, see the synthetic module.  You can add a folder
+with your own images.  It needs a labels.json file with subject boxes:
+
+    {"photo.jpg": {"subjects": [[left, top, right, bottom]]}}
+
+Usage:
+
+    bin/focalpoints-benchmark --images 20 --folder ~/labelled-photos
+"""
+from .focalpoint.detectors import DETECTORS
+from .focalpoint.transformer import CropFocalPointsTransformer
+from .focalpoint.transformer import OriginalFocalPointsTransformer
+from .synthetic import make_image
+from .synthetic import Subject
+
+import argparse
+import itertools
+import json
+import math
+import os
+import PIL.Image
+import time
+
+
+MAX_CORNERS = (20, 50)
+QUALITY_LEVELS = (0.01, 0.04, 0.1)
+# Longest side of the image used for detection.  None means full size.
+DETECTION_SIZES = (None, 1024, 512, 256)
+# Aspect ratios (width, height) for which we check the crop.
+CROP_RATIOS = ((1, 1), (16, 9), (9, 16), (4, 5))
+SYNTHETIC_SIZES = ((2400, 1600), (1600, 2400), (3000, 3000))
+
+
+class FieldStub:
+    """Stand-in for an image field value, with only what the transformers use."""
+
+    def __init__(self, size, focal_point=None):
+        self._width, self._height = size
+        self.focal_point = focal_point
+
+
+def get_synthetic_images(count):
+    """Yield (name, pil_image, subjects) for synthetic images."""
+    for index in range(count):
+        width, height = SYNTHETIC_SIZES[index % len(SYNTHETIC_SIZES)]
+        subjects = 1 + index % 2
+        image, boxes = make_image(width, height, seed=index, subjects=subjects)
+        yield f"synthetic-{index}", image, boxes
+
+
+def get_folder_images(folder):
+    """Yield (name, pil_image, subjects) for labelled images in a folder."""
+    with open(os.path.join(folder, "labels.json")) as labels_file:
+        labels = json.load(labels_file)
+    for name, label in sorted(labels.items()):
+        image = PIL.Image.open(os.path.join(folder, name))
+        image.load()
+        boxes = [Subject(*box) for box in label["subjects"]]
+        yield name, image, boxes
+
+
+def get_true_focal_point(subjects):
+    total = sum(subject.area for subject in subjects)
+    x_pos = sum(subject.center[0] * subject.area for subject in subjects) / total
+    y_pos = sum(subject.center[1] * subject.area for subject in subjects) / total
+    return x_pos, y_pos
+
+
+def get_kept_fraction(box, subjects):
+    left, top, right, bottom = box
+    kept = 0
+    for subject in subjects:
+        width = min(right, subject.right) - max(left, subject.left)
+        height = min(bottom, subject.bottom) - max(top, subject.top)
+        if width > 0 and height > 0:
+            kept += width * height
+    return kept / sum(subject.area for subject in subjects)
+
+
+def evaluate(detector, image, subjects):
+    """Evaluate the detector on one image.
+
+    Returns a dict with found, distance, kept fractions and milliseconds.
+    """
+    width, height = image.size
+    start = time.perf_counter()
+    found = detector(image)
+    focal_point = None
+    if found:
+        focal_point = OriginalFocalPointsTransformer(None).get_center_of_mass(found)
+    milliseconds = (time.perf_counter() - start) * 1000
+    if focal_point is None:
+        used_point = (width / 2, height / 2)
+    else:
+        used_point = focal_point
+    true_x, true_y = get_true_focal_point(subjects)
+    diagonal = math.hypot(width, height)
+    distance = math.hypot(used_point[0] - true_x, used_point[1] - true_y) / diagonal
+
+    transformer = CropFocalPointsTransformer(None)
+    transformer.prepare(FieldStub(image.size, used_point), "contain")
+    kept = []
+    for ratio_width, ratio_height in CROP_RATIOS:
+        box = transformer.get_crop_box(image.size, ratio_width * 100, ratio_height * 100)
+        if box is None:
+            box = (0, 0, width, height)
+        kept.append(get_kept_fraction(box, subjects))
+    return {
+        "found": focal_point is not None,
+        "distance": distance,
+        "kept": kept,
+        "ms_per_mp": milliseconds / (width * height / 1000000),
+    }
+
+
+def get_configurations(detector_names):
+    for name, max_corners, quality_level, detection_size in itertools.product(
+        detector_names, MAX_CORNERS, QUALITY_LEVELS, DETECTION_SIZES
+    ):
+        yield name, {
+            "max_corners": max_corners,
+            "quality_level": quality_level,
+            "detection_size": detection_size,
+        }
+
+
+def summarize(results):
+    kept = [fraction for result in results for fraction in result["kept"]]
+    return {
+        "found": 100 * sum(result["found"] for result in results) / len(results),
+        "distance": 100 * sum(result["distance"] for result in results) / len(results),
+        "kept": 100 * sum(kept) / len(kept),
+        "worst": 100 * min(kept),
+        "ms_per_mp": sum(result["ms_per_mp"] for result in results) / len(results),
+    }
+
+
+def format_table(rows):
+    header = (
+        f"{'detector':<12} {'corners':>7} {'quality':>7} {'size':>5} "
+        f"{'found%':>6} {'dist%':>6} {'kept%':>6} {'worst%':>6} {'ms/MP':>8}"
+    )
+    lines = [header, "-" * len(header)]
+    for name, options, summary in rows:
+        lines.append(
+            f"{name:<12} {options['max_corners']:>7} {options['quality_level']:>7} "
+            f"{options['detection_size'] or 'full':>5} "
+            f"{summary['found']:>6.1f} {summary['distance']:>6.1f} "
+            f"{summary['kept']:>6.1f} {summary['worst']:>6.1f} "
+            f"{summary['ms_per_mp']:>8.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Accuracy versus speed of focal point detector settings."
+    )
+    parser.add_argument(
+        "--images", type=int, default=12, help="Number of synthetic images."
+    )
+    parser.add_argument(
+        "--folder", help="Folder with your own images and a labels.json file."
+    )
+    parser.add_argument(
+        "--detector",
+        action="append",
+        choices=sorted(DETECTORS),
+        help="Detector to compare.  Can be repeated.  Default: all.",
+    )
+    options = parser.parse_args(argv)
+
+    images = list(get_synthetic_images(options.images))
+    if options.folder:
+        images.extend(get_folder_images(options.folder))
+    detector_names = []
+    for name in options.detector or sorted(DETECTORS):
+        if DETECTORS[name].is_available():
+            detector_names.append(name)
+        else:
+            print(f"Skipping detector {name}: its libraries are not installed.")
+    if not detector_names:
+        parser.error("No detector is available.")
+    rows = []
+    for name, detector_options in get_configurations(detector_names):
+        detector = DETECTORS[name](None, **detector_options)
+        results = [
+            evaluate(detector, image, subjects)
+            for _image_name, image, subjects in images
+        ]
+        rows.append((name, detector_options, summarize(results)))
+    rows.sort(key=lambda row: row[2]["ms_per_mp"])
+    print(format_table(rows))
+
+
+if __name__ == "__main__":
+    main()
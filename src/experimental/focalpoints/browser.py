@@ -1,7 +1,12 @@
+from html import escape
+from plone.namedfile.interfaces import IAvailableSizes
 from plone.protect.interfaces import IDisableCSRFProtection
 from plone.scale.storage import AnnotationStorage
 from Products.Five import BrowserView
+from zope.component import queryUtility
 from zope.interface import alsoProvides
+from .encoder import stats as encoder_stats
+from .focalpoint.blobs import open_image_file
 from .focalpoint.subscriber import determine_focalpoints
 
 import logging
@@ -9,19 +14,33 @@ import PIL.Image
 
 
 logger = logging.getLogger(__name__)
+# Plone uses this for a scale side without a limit.
+UNLIMITED = 65536
 
 
-def friendly_size(image_field):
-    with image_field.open() as image_file:
+def get_image_size(image_field):
+    """Get width and height without decoding the image.
+
+    The field knows its size.  Otherwise PIL only reads the header.
+    """
+    try:
+        width, height = image_field.getImageSize()
+    except AttributeError:
+        width = height = -1
+    if width > 0 and height > 0:
+        return width, height
+    with open_image_file(image_field) as image_file:
         try:
-            pil_image = PIL.Image.open(image_file)
+            return PIL.Image.open(image_file).size
         except OSError:
             # Probably: cannot identify image file
             # Locally I have experimental.gracefulblobmissing,
             # so image blobs may be wrong.
-            width = height = 0
-        else:
-            width, height = pil_image.size
+            return 0, 0
+
+
+def friendly_size(image_field):
+    width, height = get_image_size(image_field)
     if width == height:
         aspect = "square"
     elif width > height:
@@ -54,6 +73,8 @@ class ClearScales(BrowserView):
 
     def __call__(self):
         determine_focalpoints(self.context)
+        # Update the focal point catalog metadata.
+        self.context.reindexObject()
         storage = AnnotationStorage(self.context)
         count = len(storage)
         try:
@@ -87,3 +108,113 @@ class ClearScales(BrowserView):
 class ScalesTest(BrowserView):
     def size(self):
         return friendly_size(self.context.image)
+
+
+class FocalPointImageScale(BrowserView):
+    """Image tags for catalog brains, using the focal point metadata.
+
+    In a listing you would use portal/@@image_scale with brains,
+    but anything that needs the focal point would have to wake up
+    the object and its image.  This view only uses catalog metadata:
+
+        image_scale portal/@@focalpoint_image_scale;
+        tag python:image_scale.tag(brain, 'image', scale='preview')
+
+    The tag uses the standard named scale, and lets the browser crop it
+    with CSS to the box of the scale, keeping the focal point in view.
+    Pass width and height for another box, for example 400 by 225 for 16:9.
+    """
+
+    def info(self, brain, fieldname="image"):
+        """Get focal point, size and date of the image field from the brain."""
+        metadata = getattr(brain, "image_focal_points", None)
+        if not metadata:
+            return
+        return metadata.get(fieldname)
+
+    def object_position(self, brain, fieldname="image"):
+        """Get the focal point as CSS object-position."""
+        info = self.info(brain, fieldname)
+        if not info or not info["focal_point"]:
+            return "50% 50%"
+        focal_x, focal_y = info["focal_point"]
+        width, height = info["size"]
+        if not width or not height:
+            return "50% 50%"
+        return f"{100 * focal_x / width:.1f}% {100 * focal_y / height:.1f}%"
+
+    def get_box(
+        self, brain, fieldname="image", scale="preview", width=None, height=None
+    ):
+        """Get width and height of the image tag.
+
+        By default this is the size of the named scale: the image fitted
+        within the box of the scale, without upscaling.
+        When width or height is passed, this is the box that we crop to.
+        A side without limit follows the aspect ratio of the image.
+        """
+        info = self.info(brain, fieldname)
+        image_width, image_height = info["size"] if info else (0, 0)
+        if not width and not height:
+            if not image_width or not image_height:
+                return None, None
+            sizes_util = queryUtility(IAvailableSizes)
+            sizes = (sizes_util() if sizes_util is not None else None) or {}
+            scale_width, scale_height = sizes.get(scale, (0, 0))
+            factors = [1]
+            if scale_width and scale_width < UNLIMITED:
+                factors.append(scale_width / image_width)
+            if scale_height and scale_height < UNLIMITED:
+                factors.append(scale_height / image_height)
+            factor = min(factors)
+            return round(image_width * factor), round(image_height * factor)
+        if image_width and image_height:
+            if not height or height >= UNLIMITED:
+                height = round(width * image_height / image_width)
+            elif not width or width >= UNLIMITED:
+                width = round(height * image_width / image_height)
+        if not width or not height or max(width, height) >= UNLIMITED:
+            return None, None
+        return int(width), int(height)
+
+    def tag(
+        self,
+        brain,
+        fieldname="image",
+        scale="preview",
+        alt=None,
+        css_class=None,
+        width=None,
+        height=None,
+    ):
+        if self.info(brain, fieldname) is None:
+            return ""
+        url = f"{brain.getURL()}/@@images/{fieldname}/{scale}"
+        if alt is None:
+            alt = brain.Title or ""
+        style = "object-fit: cover; object-position: {}".format(
+            self.object_position(brain, fieldname)
+        )
+        parts = [
+            f'src="{escape(url)}"',
+            f'alt="{escape(alt)}"',
+        ]
+        # object-fit only crops when the element has a size.
+        width, height = self.get_box(brain, fieldname, scale, width, height)
+        if width and height:
+            parts.append(f'width="{width}" height="{height}"')
+        parts.append(f'style="{style}"')
+        if css_class:
+            parts.append(f'class="{escape(css_class)}"')
+        return "<img {} />".format(" ".join(parts))
+
+
+class EncoderStats(BrowserView):
+    """Show the scale encoder statistics of this Zope process.
+
+    See the encoder module.
+    """
+
+    def __call__(self):
+        self.request.response.setHeader("Content-Type", "text/plain")
+        return encoder_stats.format()
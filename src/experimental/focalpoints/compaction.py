@@ -0,0 +1,288 @@
+"""Report on and prune image scales in all scale storages of the site.
+
+The clear-scales view works on one object.  This job walks over all
+objects in the catalog and looks at their scale storages in annotations:
+
+- 'plone.scale' for content items,
+- the '_plone.scales' key in the data of persistent tiles on the item,
+  in 'plone.tiles.data.<tile id>', like plone.app.tiles and our tile
+  scaling store them,
+- 'plone.tiles.scale.<tile id>', like collective.cover stores them.
+
+It reports the number of scales and their bytes per portal type and per age.
+With pruning on, it removes scales that are older than the grace period
+of plone.scale (KEEP_SCALE_MILLIS, one day) and that are:
+
+- superseded: created from an older version of the image,
+  or a newer scale with the same parameters exists,
+- unreferenced: the image field is empty or gone, or the tile was removed.
+
+We commit after every batch of objects, and remember where we were
+in the site annotations.  So you can call the view repeatedly,
+and it continues where it stopped:
+
+    @@focalpoints-scale-compaction?prune=1&batch=100&batches=10
+
+Add restart=1 to start from the beginning.
+"""
+from Acquisition import aq_base
+from persistent.mapping import PersistentMapping
+from plone.protect.interfaces import IDisableCSRFProtection
+from Products.CMFCore.utils import getToolByName
+from Products.Five import BrowserView
+from zope.annotation.interfaces import IAnnotations
+from zope.interface import alsoProvides
+
+import bisect
+import copy
+import logging
+import time
+import transaction
+
+
+logger = logging.getLogger(__name__)
+ANNOTATION_KEY = "experimental.focalpoints.compaction"
+CONTENT_KEY = "plone.scale"
+TILE_SCALE_PREFIX = "plone.tiles.scale."
+TILE_DATA_PREFIX = "plone.tiles.data."
+# Key of the scales in the data of a tile, see plone.app.tiles.imagescaling.
+TILE_SCALES_KEY = "_plone.scales"
+DAY_MILLIS = 24 * 60 * 60 * 1000
+# Age buckets: maximum age in days, and label.
+AGES = ((1, "< 1 day"), (7, "< 1 week"), (30, "< 30 days"), (None, "older"))
+
+
+def get_keep_millis():
+    from plone.scale import storage
+
+    return getattr(storage, "KEEP_SCALE_MILLIS", DAY_MILLIS)
+
+
+def get_age_label(age_millis):
+    for days, label in AGES:
+        if days is None or age_millis < days * DAY_MILLIS:
+            return label
+
+
+def get_scale_size(info):
+    data = info.get("data")
+    if data is None:
+        return 0
+    try:
+        return data.getSize()
+    except AttributeError:
+        pass
+    try:
+        return len(data)
+    except TypeError:
+        return 0
+
+
+def get_fieldname(info):
+    fieldname = info.get("fieldname")
+    if fieldname:
+        return fieldname
+    # Older versions only have the fieldname in the key with all parameters.
+    try:
+        return dict(info.get("key") or ()).get("fieldname")
+    except (TypeError, ValueError):
+        return
+
+
+def iter_scale_storages(obj):
+    """Yield (annotation key, tile id, scales) for the scale storages of obj.
+
+    The tile id is None for the scales of the content item itself.
+    """
+    annotations = IAnnotations(obj, None)
+    if annotations is None:
+        return
+    for key in list(annotations.keys()):
+        if key == CONTENT_KEY:
+            yield key, None, annotations[key]
+        elif not isinstance(key, str):
+            continue
+        elif key.startswith(TILE_DATA_PREFIX):
+            data = annotations[key]
+            scales = data.get(TILE_SCALES_KEY) if hasattr(data, "get") else None
+            if scales is not None:
+                yield key, key[len(TILE_DATA_PREFIX) :], scales
+        elif key.startswith(TILE_SCALE_PREFIX):
+            yield key, key[len(TILE_SCALE_PREFIX) :], annotations[key]
+
+
+def get_tile_data(obj, tile_id):
+    """Get the data of a persistent tile, or None when it was removed."""
+    return IAnnotations(obj).get(TILE_DATA_PREFIX + tile_id)
+
+
+def get_field_value(obj, fieldname, tile_id):
+    if tile_id is None:
+        return getattr(aq_base(obj), fieldname, None)
+    data = get_tile_data(obj, tile_id)
+    if data is None:
+        return
+    return data.get(fieldname)
+
+
+def get_prune_reason(info, scales, field_value, now, keep_millis):
+    """Return why this scale can be removed, or None."""
+    modified = info.get("modified")
+    if modified and now - modified < keep_millis:
+        # Cached html may still point to this scale.
+        return
+    if field_value is None:
+        return "unreferenced"
+    value_modified = getattr(aq_base(field_value), "_p_mtime", None)
+    if modified and value_modified and modified < value_modified * 1000:
+        return "superseded"
+    key = info.get("key")
+    for other in scales.values():
+        if (
+            other is not info
+            and other.get("key") == key
+            and (other.get("modified") or 0) > (modified or 0)
+        ):
+            return "superseded"
+
+
+def new_report():
+    return {"objects": 0, "storages": 0, "types": {}, "ages": {}, "pruned": {}}
+
+
+def add_to_report(report, section, name, size):
+    count, total = report[section].get(name, (0, 0))
+    report[section][name] = (count + 1, total + size)
+
+
+def compact_object(obj, report, prune=False, now=None, keep_millis=None):
+    """Report on, and optionally prune, the scale storages of one object."""
+    if now is None:
+        now = time.time() * 1000
+    if keep_millis is None:
+        keep_millis = get_keep_millis()
+    report["objects"] += 1
+    portal_type = getattr(aq_base(obj), "portal_type", "") or "unknown"
+    for key, tile_id, scales in iter_scale_storages(obj):
+        report["storages"] += 1
+        type_name = portal_type if tile_id is None else f"{portal_type} (tile)"
+        for uid, info in list(scales.items()):
+            size = get_scale_size(info)
+            fieldname = get_fieldname(info)
+            field_value = None
+            if fieldname:
+                field_value = get_field_value(obj, fieldname, tile_id)
+            reason = get_prune_reason(info, scales, field_value, now, keep_millis)
+            if reason is not None:
+                add_to_report(report, "pruned", reason, size)
+                if prune:
+                    del scales[uid]
+                    continue
+            add_to_report(report, "types", type_name, size)
+            age = now - (info.get("modified") or 0)
+            add_to_report(report, "ages", get_age_label(age), size)
+        if prune and key.startswith(TILE_SCALE_PREFIX) and not scales:
+            if get_tile_data(obj, tile_id) is None:
+                # Empty storage of a removed tile.
+                del IAnnotations(obj)[key]
+
+
+def get_state(site, prune, restart=False):
+    annotations = IAnnotations(site)
+    state = annotations.get(ANNOTATION_KEY)
+    if state is None or restart or state.get("prune") != prune:
+        state = PersistentMapping(
+            {"prune": prune, "cursor": "", "done": False, "report": new_report()}
+        )
+        annotations[ANNOTATION_KEY] = state
+    return state
+
+
+def compact(site, prune=False, batch_size=100, max_batches=None, restart=False):
+    """Walk over all objects in batches, committing after each batch.
+
+    Continues where a previous call stopped.  Returns the state,
+    with the cursor (the last handled path), the report, and whether we are done.
+    """
+    state = get_state(site, prune, restart=restart)
+    if state["done"]:
+        return state
+    catalog = getToolByName(site, "portal_catalog")
+    paths = sorted(brain.getPath() for brain in catalog.unrestrictedSearchResults())
+    start = bisect.bisect_right(paths, state["cursor"]) if state["cursor"] else 0
+    report = copy.deepcopy(state["report"])
+    keep_millis = get_keep_millis()
+    batches = 0
+    for index in range(start, len(paths), batch_size):
+        batch = paths[index : index + batch_size]
+        now = time.time() * 1000
+        for path in batch:
+            obj = site.unrestrictedTraverse(path, None)
+            if obj is None:
+                continue
+            compact_object(obj, report, prune=prune, now=now, keep_millis=keep_millis)
+        state["cursor"] = batch[-1]
+        state["report"] = copy.deepcopy(report)
+        transaction.commit()
+        logger.info(
+            "Scale compaction handled %d of %d objects.",
+            index + len(batch),
+            len(paths),
+        )
+        batches += 1
+        if max_batches and batches >= max_batches:
+            return state
+    state["done"] = True
+    transaction.commit()
+    return state
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def format_report(state):
+    report = state["report"]
+    lines = [
+        "Done." if state["done"] else f"Not done yet.  Stopped after {state['cursor']}",
+        f"Objects: {report['objects']}, scale storages: {report['storages']}.",
+    ]
+    titles = (
+        ("types", "Kept scales per type"),
+        ("ages", "Kept scales per age"),
+        ("pruned", "Pruned scales" if state["prune"] else "Scales that can be pruned"),
+    )
+    for section, title in titles:
+        lines.extend(["", title])
+        for name, (count, size) in sorted(report[section].items()):
+            lines.append(f"  {name:<30} {count:>8} {format_size(size):>10}")
+    return "\n".join(lines)
+
+
+class ScaleCompaction(BrowserView):
+    """Report on the scale storages of the site, and optionally prune them.
+
+    See the module docstring for the request parameters.
+    """
+
+    def get_int(self, name, default):
+        try:
+            return int(self.request.get(name, default))
+        except (ValueError, TypeError):
+            return default
+
+    def __call__(self):
+        alsoProvides(self.request, IDisableCSRFProtection)
+        state = compact(
+            self.context,
+            prune=self.get_int("prune", 0) > 0,
+            batch_size=max(self.get_int("batch", 100), 1),
+            max_batches=self.get_int("batches", 10) or None,
+            restart=self.get_int("restart", 0) > 0,
+        )
+        self.request.response.setHeader("Content-Type", "text/plain")
+        return format_report(state)
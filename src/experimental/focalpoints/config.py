@@ -0,0 +1,130 @@
+"""Configuration options.
+
+All options are read from environment variables when Zope starts.
+In buildout you can set them in the environment-vars of the instance part:
+
+    [instance]
+    environment-vars =
+        FOCALPOINTS_PYRAMID on
+"""
+import os
+
+
+def get_bool(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_int(name, default=0):
+    try:
+        return int(os.environ[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def get_float(name, default=0.0):
+    try:
+        return float(os.environ[name])
+    except (KeyError, ValueError):
+        return default
+
+
+# Store a pyramid of power-of-two reduced versions of the original
+# next to the image field, when focal points are determined.
+# Scales are then created from the smallest level that is large enough.
+PYRAMID = get_bool("FOCALPOINTS_PYRAMID")
+# Do not create pyramid levels with a side smaller than this.
+PYRAMID_MIN_SIZE = get_int("FOCALPOINTS_PYRAMID_MIN_SIZE", 256)
+
+# Number of threads OpenCV may use.  By default OpenCV uses all cores,
+# in every thread of every Zope instance.  Set to 1 to avoid oversubscription.
+# When not set, we leave the OpenCV default alone.
+CV2_THREADS = get_int("FOCALPOINTS_CV2_THREADS", None)
+# Maximum number of heavy image operations (detection, scaling, pyramids)
+# running at the same time in this process.  0 means no limit.
+MAX_CONCURRENT = get_int("FOCALPOINTS_MAX_CONCURRENT", 0)
+# Seconds to wait for a free slot.  After this, detection and pyramid levels
+# are skipped, and scales are created without focal point cropping.
+QUEUE_TIMEOUT = get_float("FOCALPOINTS_QUEUE_TIMEOUT", 10.0)
+# Seconds that such a standard scale waits for a free slot.
+# After this it is created anyway: a page needs its images.
+FALLBACK_TIMEOUT = get_float("FOCALPOINTS_FALLBACK_TIMEOUT", 2.0)
+
+# Directory where profiles of slow scale and detection operations are written.
+# When not set, profiling is off.
+PROFILE_DIR = os.environ.get("FOCALPOINTS_PROFILE_DIR", "")
+# When an operation on an image takes longer than this many seconds,
+# we profile the next operation on the same image.  0 means: never.
+# Managers can always request a profile with ?focalpoints-profile=1.
+PROFILE_THRESHOLD = get_float("FOCALPOINTS_PROFILE_THRESHOLD", 0.0)
+# Minimum number of seconds between two profiles triggered by the threshold.
+PROFILE_INTERVAL = get_float("FOCALPOINTS_PROFILE_INTERVAL", 300.0)
+
+# Import OpenCV and NumPy in a background thread when Zope has started,
+# so the first detection does not have to wait for it.
+WARMUP = get_bool("FOCALPOINTS_WARMUP")
+
+# Feature detector: 'opencv' (cv2.goodFeaturesToTrack), 'numpy' (the same
+# algorithm in NumPy, so OpenCV need not be installed), or 'auto':
+# use OpenCV when it is installed.
+DETECTOR = os.environ.get("FOCALPOINTS_DETECTOR", "auto").strip().lower()
+
+# Open committed blob files with mmap when decoding originals.
+# When off, we use a plain buffered file handle.
+BLOB_MMAP = get_bool("FOCALPOINTS_BLOB_MMAP", True)
+
+# How to place the crop box for focal point scales:
+# 'center' centers it on the focal point (the center of mass of the features),
+# 'window' picks the position that contains the most features.
+CROP_STRATEGY = os.environ.get("FOCALPOINTS_CROP_STRATEGY", "center").strip().lower()
+
+# After an image or its focal point changes, keep serving the previous
+# crop scales for at most this many seconds, while a background thread
+# creates the new ones.  0 means: off, create them in the request.
+STALE_MAX_AGE = get_float("FOCALPOINTS_STALE_MAX_AGE", 0.0)
+
+# Choose how to encode a scale by its size, see the encoder module.
+ENCODER_PROFILES = get_bool("FOCALPOINTS_ENCODER_PROFILES")
+# Scales with a longest side up to this size are small: no optimize pass.
+ENCODER_SMALL_SIZE = get_int("FOCALPOINTS_ENCODER_SMALL_SIZE", 300)
+# Scales with a longest side from this size are large: search the quality.
+ENCODER_LARGE_SIZE = get_int("FOCALPOINTS_ENCODER_LARGE_SIZE", 1200)
+# For large JPEG scales: lowest quality with at least this PSNR in dB.
+ENCODER_MIN_PSNR = get_float("FOCALPOINTS_ENCODER_MIN_PSNR", 0.0)
+# For large JPEG scales, when no PSNR is set: highest quality that fits
+# in this many bytes per pixel.
+ENCODER_TARGET_BPP = get_float("FOCALPOINTS_ENCODER_TARGET_BPP", 0.0)
+# Never search below this quality.
+ENCODER_MIN_QUALITY = get_int("FOCALPOINTS_ENCODER_MIN_QUALITY", 60)
+
+# Determine focal points of several image fields of one item at the same time,
+# with at most this many threads in the process.  0 or 1: one after another.
+DETECTION_THREADS = get_int("FOCALPOINTS_DETECTION_THREADS", 0)
+
+# Keep decoded originals on the request, so detection and scaling in the
+# same request decode them only once.  Maximum megabytes.  0 means: off.
+DECODE_CACHE_MB = get_int("FOCALPOINTS_DECODE_CACHE_MB", 0)
+
+# Determine the focal point of an image that never went through detection,
+# for example uploaded before this package was installed, the first time
+# a crop is created.  We use the original that was decoded for the crop.
+LAZY_DETECTION = get_bool("FOCALPOINTS_LAZY_DETECTION")
+# Detect on a reduced image with at most this size on the longest side.
+# 0 means: use the setting of the detector.
+LAZY_DETECTION_SIZE = get_int("FOCALPOINTS_LAZY_DETECTION_SIZE", 512)
+
+# Share decoded originals between the Zope processes on this host,
+# in shared memory.  Maximum megabytes for the whole host.  0 means: off.
+SHARED_CACHE_MB = get_int("FOCALPOINTS_SHARED_CACHE_MB", 0)
+# Directory with the index of the shared cache.  Processes that share,
+# use the same directory.  By default a directory in the temporary directory.
+SHARED_CACHE_DIR = os.environ.get("FOCALPOINTS_SHARED_CACHE_DIR", "")
+
+# Record every scale request as a JSON line in this file,
+# for the focalpoints-replay script.  When not set, recording is off.
+RECORD_FILE = os.environ.get("FOCALPOINTS_RECORD_FILE", "")
+# Start a new file after this many megabytes, and keep this many old files.
+RECORD_MAX_MB = get_int("FOCALPOINTS_RECORD_MAX_MB", 100)
+RECORD_BACKUPS = get_int("FOCALPOINTS_RECORD_BACKUPS", 5)
@@ -0,0 +1,195 @@
+"""Encoder profiles for scales, chosen by the size of the scale.
+
+By default every scale is saved with the same quality, optimize and
+progressive.  For a thumbnail the optimize pass costs CPU for a few bytes,
+and a large hero image may still be bigger than needed.
+
+With FOCALPOINTS_ENCODER_PROFILES on, we pick a profile by the longest
+side of the scale:
+
+- small (up to FOCALPOINTS_ENCODER_SMALL_SIZE): no optimize pass,
+  no progressive encoding,
+- medium: like before,
+- large (from FOCALPOINTS_ENCODER_LARGE_SIZE): for JPEG we search the quality.
+  With FOCALPOINTS_ENCODER_MIN_PSNR we take the lowest quality that still has
+  this peak signal-to-noise ratio in dB compared to the unencoded scale.
+  Otherwise, with FOCALPOINTS_ENCODER_TARGET_BPP, we take the highest quality
+  that fits in this many bytes per pixel.  The quality stays between
+  FOCALPOINTS_ENCODER_MIN_QUALITY and the requested quality.
+
+We keep statistics per profile and format: count, pixels, bytes, average quality and
+encoding time.  Managers can see them in @@focalpoints-encoder-stats.
+"""
+from . import config
+from dataclasses import dataclass
+from io import BytesIO
+
+import logging
+import math
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class EncoderProfile:
+    name: str
+    optimize: bool = True
+    progressive: bool = True
+    search: bool = False
+
+
+SMALL = EncoderProfile("small", optimize=False, progressive=False)
+MEDIUM = EncoderProfile("medium")
+LARGE = EncoderProfile("large", search=True)
+# Used when profiles are off.
+DEFAULT = EncoderProfile("default")
+
+
+def get_profile(size):
+    """Get the encoder profile for a scale of this size."""
+    if not config.ENCODER_PROFILES:
+        return DEFAULT
+    longest = max(size)
+    if longest <= config.ENCODER_SMALL_SIZE:
+        return SMALL
+    if longest >= config.ENCODER_LARGE_SIZE:
+        return LARGE
+    return MEDIUM
+
+
+def save(pil_image, result, format_, quality, profile, icc_profile=None):
+    pil_image.save(
+        result,
+        format_,
+        quality=quality,
+        optimize=profile.optimize,
+        progressive=profile.progressive,
+        icc_profile=icc_profile,
+    )
+
+
+def get_psnr(pil_image, data):
+    """Peak signal-to-noise ratio in dB of the encoded data, on the gray image."""
+    import numpy as np
+    import PIL.Image
+
+    original = np.asarray(pil_image.convert("L"), dtype=np.float32)
+    encoded = np.asarray(PIL.Image.open(BytesIO(data)).convert("L"), dtype=np.float32)
+    mse = float(np.mean((original - encoded) ** 2))
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255 * 255 / mse)
+
+
+def search_quality(pil_image, format_, quality):
+    """Search the JPEG quality for a large scale.
+
+    Returns the quality, or the given quality when there is nothing to search.
+    """
+    low = min(config.ENCODER_MIN_QUALITY, quality)
+    high = quality
+    # Trial encodes are without optimize pass, which mostly saves bytes,
+    # and hardly changes the image.
+    trial_profile = EncoderProfile("trial", optimize=False, progressive=False)
+
+    def encode_trial(candidate):
+        trial = BytesIO()
+        save(pil_image, trial, format_, candidate, trial_profile)
+        return trial.getvalue()
+
+    if config.ENCODER_MIN_PSNR > 0:
+        # Find the lowest quality that is still good enough.
+        best = high
+        while low <= high:
+            middle = (low + high) // 2
+            if get_psnr(pil_image, encode_trial(middle)) >= config.ENCODER_MIN_PSNR:
+                best = middle
+                high = middle - 1
+            else:
+                low = middle + 1
+        return best
+    if config.ENCODER_TARGET_BPP > 0:
+        # Find the highest quality that fits in the target size.
+        target = config.ENCODER_TARGET_BPP * pil_image.size[0] * pil_image.size[1]
+        best = low
+        while low <= high:
+            middle = (low + high) // 2
+            if len(encode_trial(middle)) <= target:
+                best = middle
+                low = middle + 1
+            else:
+                high = middle - 1
+        return best
+    return quality
+
+
+class EncoderStats:
+    """Thread-safe totals per encoder profile."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = {}
+
+    def record(self, profile, format_, pixels, size, quality, seconds):
+        key = (profile.name, format_)
+        with self._lock:
+            count, total_pixels, total_size, total_quality, total_seconds = (
+                self.totals.get(key, (0, 0, 0, 0, 0.0))
+            )
+            self.totals[key] = (
+                count + 1,
+                total_pixels + pixels,
+                total_size + size,
+                total_quality + quality,
+                total_seconds + seconds,
+            )
+
+    def format(self):
+        lines = [
+            f"{'profile':<8} {'format':<6} {'count':>7} {'bytes/px':>9} "
+            f"{'quality':>8} {'ms':>8}"
+        ]
+        with self._lock:
+            totals = sorted(self.totals.items())
+        for (name, format_), (count, pixels, size, quality, seconds) in totals:
+            lines.append(
+                f"{name:<8} {format_:<6} {count:>7} {size / max(pixels, 1):>9.3f} "
+                f"{quality / count:>8.1f} {1000 * seconds / count:>8.1f}"
+            )
+        return "\n".join(lines)
+
+
+stats = EncoderStats()
+
+
+def encode(pil_image, format_, quality, icc_profile=None, result=None):
+    """Encode the image with the profile for its size.
+
+    Writes to the result file when given, otherwise returns the data.
+    """
+    start = time.perf_counter()
+    profile = get_profile(pil_image.size)
+    if profile.search and format_ == "JPEG":
+        quality = search_quality(pil_image, format_, quality)
+    target = BytesIO() if result is None else result
+    save(pil_image, target, format_, quality, profile, icc_profile=icc_profile)
+    size = target.tell()
+    seconds = time.perf_counter() - start
+    pixels = pil_image.size[0] * pil_image.size[1]
+    stats.record(profile, format_, pixels, size, quality, seconds)
+    logger.debug(
+        "Encoded %dx%d %s with profile %s, quality %d: %d bytes in %.3f seconds.",
+        pil_image.size[0],
+        pil_image.size[1],
+        format_,
+        profile.name,
+        quality,
+        size,
+        seconds,
+    )
+    if result is None:
+        return target.getvalue()
+    return result
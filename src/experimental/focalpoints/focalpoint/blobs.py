@@ -0,0 +1,140 @@
+"""Read image data for decoding without copying it.
+
+Pillow only needs a file-like object that it can read and seek in.
+
+- For a committed ZODB blob, we open the blob file directly,
+  with mmap or as buffered file handle.  This skips the BlobFile
+  bookkeeping of the connection.
+- For data stored in a chain of file chunks, we stream the chunks
+  instead of joining them into one big string.
+- Otherwise we fall back to value.open() or value.data, like before.
+"""
+from .. import config
+from Acquisition import aq_base
+from contextlib import contextmanager
+from plone.namedfile.file import FILECHUNK_CLASSES
+from ZODB.interfaces import BlobError
+
+import bisect
+import hashlib
+import io
+import logging
+import mmap
+
+
+logger = logging.getLogger(__name__)
+CHUNK_SIZE = 1 << 20
+
+
+def open_committed_blob(blob):
+    """Open the file of a committed blob for reading.
+
+    Returns None when the blob is not committed, for example
+    when it was created in the current transaction.
+    """
+    try:
+        filename = blob.committed()
+    except (BlobError, AttributeError):
+        return
+    blob_file = open(filename, "rb")
+    if not config.BLOB_MMAP:
+        return blob_file
+    try:
+        mapped = mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # For example an empty file.
+        return blob_file
+    # The mmap keeps its own handle, so we can close the file.
+    blob_file.close()
+    return mapped
+
+
+def open_image_data(value):
+    """Open the image data of a field value for reading.
+
+    Returns a file-like object, or bytes, or None.
+    The caller should close the result when it has a close method.
+    """
+    blob = getattr(aq_base(value), "_blob", None)
+    if blob is not None:
+        image_file = open_committed_blob(blob)
+        if image_file is not None:
+            return image_file
+    try:
+        data = value.open()
+    except AttributeError:
+        data = getattr(aq_base(value), "data", value)
+    if isinstance(data, tuple(FILECHUNK_CLASSES)):
+        # Large data stored in a chain of chunks.  Stream it.
+        return io.BufferedReader(ChunkReader(data))
+    return data
+
+
+@contextmanager
+def open_image_file(value):
+    """Context manager giving a file-like object with the image data."""
+    data = open_image_data(value)
+    if isinstance(data, bytes):
+        data = io.BytesIO(data)
+    try:
+        yield data
+    finally:
+        if hasattr(data, "close"):
+            data.close()
+
+
+def get_digest(value):
+    """Get the sha256 hex digest of the image data, reading it in chunks."""
+    digest = hashlib.sha256()
+    with open_image_file(value) as image_file:
+        for chunk in iter(lambda: image_file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ChunkReader(io.RawIOBase):
+    """Seekable reader over a chain of file chunks (OFS.Image.Pdata).
+
+    Each chunk has a 'data' and a 'next' attribute.
+    """
+
+    def __init__(self, first_chunk):
+        self._chunks = []
+        self._offsets = []
+        offset = 0
+        chunk = first_chunk
+        while chunk is not None:
+            self._chunks.append(chunk)
+            self._offsets.append(offset)
+            offset += len(chunk.data)
+            chunk = chunk.next
+        self._size = offset
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(offset, 0)
+        return self._position
+
+    def readinto(self, buffer):
+        if self._position >= self._size:
+            return 0
+        index = bisect.bisect_right(self._offsets, self._position) - 1
+        data = self._chunks[index].data
+        start = self._position - self._offsets[index]
+        size = min(len(buffer), len(data) - start)
+        buffer[:size] = memoryview(data)[start : start + size]
+        self._position += size
+        return size
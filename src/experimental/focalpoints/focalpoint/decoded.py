@@ -0,0 +1,197 @@
+"""Reuse decoded images within one request.
+
+On upload, focal point detection decodes the original.  Then the field is
+often detected again by the modified event, and the page that is shown next
+asks for a few crops, which decode the same original each time.
+
+With FOCALPOINTS_DECODE_CACHE_MB set, we keep fully decoded images,
+and their gray scale version for detection, on the request.
+The key is the identity of the blob of the image field value.
+We keep a reference to the blob, so the identity is not reused.
+When the images take more than the given megabytes,
+the least recently used are dropped.  Everything is gone with the request.
+
+With FOCALPOINTS_SHARED_CACHE_MB set, we also look in the shared cache
+of the host, and share what we decode, see the shared module.
+Its key is the digest of the committed image data.
+"""
+from .. import config
+from .blobs import get_digest
+from .shared import get_shared_cache
+from .shared import is_shared
+from Acquisition import aq_base
+from collections import OrderedDict
+from zope.annotation.interfaces import IAnnotations
+from zope.globalrequest import getRequest
+
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+ANNOTATION_KEY = "experimental.focalpoints.decoded"
+# Digests of committed blobs by oid and serial, so we read each blob once.
+DIGESTS_MAX = 1000
+_digests = OrderedDict()
+_digests_lock = threading.Lock()
+
+
+def get_image_bytes(pil_image):
+    """Estimate the memory of a decoded image."""
+    return pil_image.size[0] * pil_image.size[1] * len(pil_image.getbands())
+
+
+def is_loaded(pil_image):
+    """Are the pixels of this image decoded?"""
+    return not getattr(pil_image, "tile", None)
+
+
+class DecodedImage:
+    """A decoded image with its gray scale version."""
+
+    def __init__(self, blob, pil_image):
+        # Keep the blob, so its id stays unique while we use it as key.
+        self.blob = blob
+        self.pil_image = pil_image
+        self.gray = None
+
+    @property
+    def size(self):
+        size = get_image_bytes(self.pil_image)
+        if self.gray is not None:
+            size += get_image_bytes(self.gray)
+        return size
+
+
+class DecodedImageCache:
+    """Size-bounded cache of decoded images, least recently used first."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+
+    def get_key(self, value):
+        blob = getattr(aq_base(value), "_blob", None)
+        if blob is None:
+            blob = aq_base(value)
+        return id(blob), blob
+
+    def get(self, value):
+        key, _blob = self.get_key(value)
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        self.entries.move_to_end(key)
+        return entry.pil_image
+
+    def add(self, value, pil_image):
+        if not is_loaded(pil_image):
+            return
+        key, blob = self.get_key(value)
+        entry = self.entries.get(key)
+        if entry is None or entry.pil_image is not pil_image:
+            self.entries[key] = DecodedImage(blob, pil_image)
+        self.entries.move_to_end(key)
+        self.shrink()
+
+    def get_gray(self, pil_image):
+        """Get the gray scale version of a cached image, converting it once."""
+        for entry in self.entries.values():
+            if entry.pil_image is pil_image:
+                if entry.gray is None:
+                    entry.gray = pil_image.convert("L")
+                    self.shrink()
+                return entry.gray
+        return pil_image.convert("L")
+
+    def shrink(self):
+        total = sum(entry.size for entry in self.entries.values())
+        while total > self.max_bytes and self.entries:
+            _key, entry = self.entries.popitem(last=False)
+            total -= entry.size
+            logger.debug("Dropped decoded image of %d bytes.", entry.size)
+
+
+def get_cache():
+    """Get the cache of the current request, or None when off or no request."""
+    if config.DECODE_CACHE_MB <= 0:
+        return
+    request = getRequest()
+    if request is None:
+        return
+    annotations = IAnnotations(request)
+    cache = annotations.get(ANNOTATION_KEY)
+    if cache is None:
+        cache = DecodedImageCache(config.DECODE_CACHE_MB * 1024 * 1024)
+        annotations[ANNOTATION_KEY] = cache
+    return cache
+
+
+def get_blob_digest(value):
+    """Get the digest of the committed image data, or None."""
+    blob = getattr(aq_base(value), "_blob", None)
+    oid = getattr(blob, "_p_oid", None)
+    if oid is None or getattr(blob, "_p_blob_uncommitted", None) is not None:
+        # New or changed in this transaction.
+        return
+    key = (oid, blob._p_serial)
+    with _digests_lock:
+        digest = _digests.get(key)
+        if digest is not None:
+            _digests.move_to_end(key)
+            return digest
+    digest = get_digest(value)
+    with _digests_lock:
+        _digests[key] = digest
+        while len(_digests) > DIGESTS_MAX:
+            _digests.popitem(last=False)
+    return digest
+
+
+def get_decoded_image(value):
+    """Get the decoded image of this field value from the request,
+    or from the shared cache of the host.  Returns None when not found.
+    """
+    cache = get_cache()
+    if cache is not None:
+        pil_image = cache.get(value)
+        if pil_image is not None:
+            return pil_image
+    shared = get_shared_cache()
+    if shared is None:
+        return
+    digest = get_blob_digest(value)
+    if digest is None:
+        return
+    pil_image = shared.get(digest)
+    if pil_image is not None and cache is not None:
+        cache.add(value, pil_image)
+    return pil_image
+
+
+def remember_decoded_image(value, pil_image):
+    """Keep the decoded image of this field value for the rest of the request,
+    and share it with the other processes on this host.
+    """
+    cache = get_cache()
+    if cache is not None:
+        cache.add(value, pil_image)
+    shared = get_shared_cache()
+    if shared is None or not is_loaded(pil_image) or is_shared(pil_image):
+        return
+    digest = get_blob_digest(value)
+    if digest is None:
+        return
+    try:
+        shared.put(digest, pil_image)
+    except OSError:
+        # For example: no space left in /dev/shm.
+        logger.warning("Could not share decoded image %s", digest, exc_info=True)
+
+
+def to_gray(pil_image):
+    """Convert to gray scale, reusing an earlier conversion of a cached image."""
+    cache = get_cache()
+    if cache is None:
+        return pil_image.convert("L")
+    return cache.get_gray(pil_image)
@@ -1,27 +1,97 @@
+from .. import config
+from ..limiter import heavy_operation
 from .point import FocalPoint
 
-import cv2
 import logging
-import numpy as np
+import PIL.Image
 
 
 logger = logging.getLogger(__name__)
+# OpenCV is imported on first use, see get_cv2.
+_cv2 = None
+
+
+def get_cv2():
+    """Import OpenCV on first use.
+
+    Our zcml registers data managers and a scaling factory, which import
+    this module when Zope starts.  Importing OpenCV and NumPy costs tens of MB
+    and noticeable startup time in every process, also in instances that
+    never detect anything.  So we wait until we need it.
+    """
+    global _cv2
+    if _cv2 is None:
+        import cv2
+
+        if config.CV2_THREADS is not None:
+            cv2.setNumThreads(config.CV2_THREADS)
+        _cv2 = cv2
+    return _cv2
+
+
+def to_gray(pil_image):
+    """Convert to gray scale.
+
+    In Zope we reuse the conversion of an image that was decoded earlier
+    in the request.  The benchmark scripts run without Zope.
+    """
+    try:
+        from .decoded import to_gray as to_cached_gray
+    except ImportError:
+        return pil_image.convert("L")
+    return to_cached_gray(pil_image)
 
 
 class BaseFocalpointDetector:
-    def __init__(self, context):
+    def __init__(self, context, **options):
         self.context = context
+        # Override class attributes, for example to compare settings.
+        for key, value in options.items():
+            if not hasattr(self, key):
+                raise TypeError(f"Unknown option for {self.__class__.__name__}: {key}")
+            setattr(self, key, value)
+
+    @classmethod
+    def is_available(cls):
+        """Are the libraries that this detector needs installed?"""
+        return True
 
 
 class FeatureFocalpointDetector(BaseFocalpointDetector):
     # Weight of the focal point.
     weight = 1.0
+    # Options for cv2.goodFeaturesToTrack.
+    max_corners = 20
+    quality_level = 0.04
+    min_distance = 1.0
+    # Detect on a reduced image with at most this size on the longest side.
+    # None means: detect on the full image.
+    detection_size = None
+
+    @classmethod
+    def is_available(cls):
+        try:
+            import numpy  # noqa: F401
+
+            get_cv2()
+        except ImportError:
+            return False
+        return True
 
     def __call__(self, pil_image):
+        # This may raise limiter.Saturated.
+        with heavy_operation("feature detection"):
+            return self.detect(pil_image)
+
+    def detect(self, pil_image):
         # Adapted from thumbor.detectors.feature_detector.__init__.py
+        import numpy as np
+
         try:
-            # Convert to gray scale:
-            pil_image = pil_image.convert("L")
+            original_width, original_height = pil_image.size
+            # Convert to gray scale, or reuse the conversion of the request.
+            pil_image = to_gray(pil_image)
+            pil_image = self.reduce(pil_image)
             # Note: we need a numpy array as input for cv2
             img = np.array(pil_image)
         except Exception as error:
@@ -29,17 +99,162 @@ class FeatureFocalpointDetector(BaseFocalpointDetector):
             logger.warning("Error during feature detection.")
             return
 
-        points = cv2.goodFeaturesToTrack(
-            img,
-            maxCorners=20,
-            qualityLevel=0.04,
-            minDistance=1.0,
-            useHarrisDetector=False,
-        )
-        if points is None:
+        points = self.find_corners(img)
+        if points is None or not len(points):
             return
+        # Points on a reduced image need to be scaled to the original.
+        factor_x = original_width / pil_image.size[0]
+        factor_y = original_height / pil_image.size[1]
         focal_points = []
         for point in points:
             x_pos, y_pos = point.ravel()
-            focal_points.append(FocalPoint(x_pos.item(), y_pos.item(), self.weight))
+            focal_points.append(
+                FocalPoint(x_pos.item() * factor_x, y_pos.item() * factor_y, self.weight)
+            )
         return focal_points
+
+    def find_corners(self, img):
+        """Find corners in the gray scale numpy array.
+
+        Returns an array of (x, y) points, strongest first, or None.
+        """
+        cv2 = get_cv2()
+        return cv2.goodFeaturesToTrack(
+            img,
+            maxCorners=self.max_corners,
+            qualityLevel=self.quality_level,
+            minDistance=self.min_distance,
+            useHarrisDetector=False,
+        )
+
+    def reduce(self, pil_image):
+        """Reduce the image to the detection size, if set."""
+        if not self.detection_size:
+            return pil_image
+        width, height = pil_image.size
+        factor = self.detection_size / max(width, height)
+        if factor >= 1:
+            return pil_image
+        size = (max(int(width * factor), 1), max(int(height * factor), 1))
+        return pil_image.resize(size, PIL.Image.BOX)
+
+
+def _sum3(array):
+    """Sum over the 3x3 neighbourhood of each pixel, reflecting at the border."""
+    import numpy as np
+
+    padded = np.pad(array, 1, mode="reflect")
+    rows = padded[:-2] + padded[1:-1] + padded[2:]
+    return rows[:, :-2] + rows[:, 1:-1] + rows[:, 2:]
+
+
+def _max3(array):
+    """Maximum over the 3x3 neighbourhood of each pixel."""
+    import numpy as np
+
+    padded = np.pad(array, 1, mode="edge")
+    rows = np.maximum(np.maximum(padded[:-2], padded[1:-1]), padded[2:])
+    return np.maximum(np.maximum(rows[:, :-2], rows[:, 1:-1]), rows[:, 2:])
+
+
+class ShiTomasiFocalpointDetector(FeatureFocalpointDetector):
+    """Shi-Tomasi corner detector in NumPy, without OpenCV.
+
+    This does the same as cv2.goodFeaturesToTrack with its default
+    block size 3 and Sobel aperture 3:
+
+    - Sobel derivatives of the gray image,
+    - per pixel the minimum eigenvalue of the gradient covariance matrix,
+      summed over a 3x3 block,
+    - keep pixels with at least quality_level times the strongest response,
+    - non-maximum suppression in a 3x3 neighbourhood,
+    - take the strongest, at least min_distance apart, at most max_corners.
+
+    All steps are vectorised, and we detect on a reduced image by default,
+    so this is fast enough without OpenCV.
+    """
+
+    detection_size = 512
+
+    @classmethod
+    def is_available(cls):
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def find_corners(self, img):
+        import numpy as np
+
+        if min(img.shape) < 3:
+            return
+        img = img.astype(np.float32)
+        # Sobel derivatives.
+        padded = np.pad(img, 1, mode="reflect")
+        diff_x = padded[:, 2:] - padded[:, :-2]
+        grad_x = diff_x[:-2] + 2 * diff_x[1:-1] + diff_x[2:]
+        diff_y = padded[2:] - padded[:-2]
+        grad_y = diff_y[:, :-2] + 2 * diff_y[:, 1:-1] + diff_y[:, 2:]
+        del padded, diff_x, diff_y
+        # Covariance matrix [[a, b], [b, c]] summed over the block.
+        a = _sum3(grad_x * grad_x)
+        b = _sum3(grad_x * grad_y)
+        c = _sum3(grad_y * grad_y)
+        del grad_x, grad_y
+        # Minimum eigenvalue of the matrix.
+        half_trace = (a + c) / 2
+        response = half_trace - np.sqrt(((a - c) / 2) ** 2 + b * b)
+        del a, b, c, half_trace
+        strongest = response.max()
+        if strongest <= 0:
+            return
+        candidates = (response >= self.quality_level * strongest) & (
+            response == _max3(response)
+        )
+        y_pos, x_pos = np.nonzero(candidates)
+        order = np.argsort(-response[y_pos, x_pos], kind="stable")
+        x_pos = x_pos[order].astype(np.float32)
+        y_pos = y_pos[order].astype(np.float32)
+
+        # Greedily take the strongest points that are far enough apart.
+        min_distance_squared = self.min_distance * self.min_distance
+        accepted = np.empty((self.max_corners, 2), dtype=np.float32)
+        count = 0
+        for x_candidate, y_candidate in zip(x_pos, y_pos):
+            if count:
+                distances = (accepted[:count, 0] - x_candidate) ** 2 + (
+                    accepted[:count, 1] - y_candidate
+                ) ** 2
+                if distances.min() < min_distance_squared:
+                    continue
+            accepted[count] = x_candidate, y_candidate
+            count += 1
+            if count == self.max_corners:
+                break
+        return accepted[:count]
+
+
+# Detectors that can be chosen with the FOCALPOINTS_DETECTOR option.
+DETECTORS = {
+    "opencv": FeatureFocalpointDetector,
+    "numpy": ShiTomasiFocalpointDetector,
+}
+
+
+def get_detector_class():
+    """Get the configured feature detector class.
+
+    With 'auto' we use OpenCV when it is installed, otherwise NumPy.
+    """
+    name = config.DETECTOR
+    if name == "auto":
+        if FeatureFocalpointDetector.is_available():
+            name = "opencv"
+        else:
+            name = "numpy"
+    try:
+        return DETECTORS[name]
+    except KeyError:
+        logger.warning("Unknown detector %r, using numpy.", name)
+        return ShiTomasiFocalpointDetector
@@ -0,0 +1,30 @@
+from .orientation import get_displayed_size
+from .subscriber import get_image_fields
+from plone.dexterity.interfaces import IDexterityContent
+from plone.indexer import indexer
+
+
+@indexer(IDexterityContent)
+def image_focal_points(obj):
+    """Catalog metadata with focal point information per image field.
+
+    Listings can use this without waking up the object and its image:
+
+        {"image": {"focal_point": (x, y), "size": (width, height), "date": 1.0}}
+
+    The focal point is None when none was found, and the date is when
+    detection ran, in seconds since the epoch.  Focal point and size are
+    in displayed coordinates, so with the EXIF orientation applied.
+    """
+    info = {}
+    for name, value in get_image_fields(obj):
+        focal_point = getattr(value, "focal_point", None)
+        info[name] = {
+            "focal_point": tuple(focal_point) if focal_point else None,
+            "size": get_displayed_size(value),
+            "date": getattr(value, "focal_point_date", None),
+        }
+    if not info:
+        # Do not store anything.
+        raise AttributeError("image_focal_points")
+    return info
@@ -0,0 +1,116 @@
+"""EXIF orientation as coordinate transforms.
+
+Cameras often store photos with the pixels rotated, plus an EXIF orientation
+tag that tells how to show them.  PIL.ImageOps.exif_transpose would rotate
+the whole original, which costs memory and time.  Instead we keep working
+on the raw pixels, and transform coordinates:
+
+- Focal points are stored in displayed coordinates.
+- The orientation is stored on the field, when it is not 1,
+  so we know the displayed size without opening the image.
+- Detected points are transformed from raw to displayed coordinates.
+- Crop boxes are determined in displayed coordinates,
+  and transformed back to raw coordinates before cropping.
+- Only the small, resized, result gets transposed.
+
+The orientation values are from the EXIF specification.
+The transpose methods are the same as in PIL.ImageOps.exif_transpose.
+"""
+import PIL.Image
+
+
+ORIENTATION_TAG = 0x0112
+TRANSPOSE_METHODS = {
+    2: PIL.Image.FLIP_LEFT_RIGHT,
+    3: PIL.Image.ROTATE_180,
+    4: PIL.Image.FLIP_TOP_BOTTOM,
+    5: PIL.Image.TRANSPOSE,
+    6: PIL.Image.ROTATE_270,
+    7: PIL.Image.TRANSVERSE,
+    8: PIL.Image.ROTATE_90,
+}
+# Rotating one way is undone by rotating the other way.
+# All other orientations undo themselves.
+INVERSE = {6: 8, 8: 6}
+# Orientations where width and height are swapped.
+SWAPPED = (5, 6, 7, 8)
+
+
+def get_orientation(pil_image):
+    """Get the EXIF orientation of the image, 1 when unknown."""
+    try:
+        orientation = pil_image.getexif().get(ORIENTATION_TAG, 1)
+    except Exception:
+        # Broken EXIF data should not stop us.
+        return 1
+    if orientation not in TRANSPOSE_METHODS:
+        return 1
+    return orientation
+
+
+def swap_size(size, orientation):
+    """Swap width and height when the orientation needs it.
+
+    This works in both directions: raw to displayed and back.
+    """
+    width, height = size
+    if orientation in SWAPPED:
+        return height, width
+    return width, height
+
+
+def get_displayed_size(field_value, orientation=None):
+    """Get the displayed size of an image field value.
+
+    The field knows the size of its raw pixels.  Detection stores the
+    orientation on the field when it is not 1.
+    """
+    if orientation is None:
+        orientation = getattr(field_value, "orientation", 1)
+    size = (getattr(field_value, "_width", 0), getattr(field_value, "_height", 0))
+    return swap_size(size, orientation)
+
+
+def transpose_point(x, y, size, orientation):
+    """Transform a point from raw to displayed coordinates.
+
+    The size is the size of the raw image.
+    """
+    width, height = size
+    if orientation == 2:
+        return width - x, y
+    if orientation == 3:
+        return width - x, height - y
+    if orientation == 4:
+        return x, height - y
+    if orientation == 5:
+        return y, x
+    if orientation == 6:
+        return height - y, x
+    if orientation == 7:
+        return height - y, width - x
+    if orientation == 8:
+        return y, width - x
+    return x, y
+
+
+def untranspose_box(box, displayed_size, orientation):
+    """Transform a box (left, top, right, bottom) from displayed to raw coordinates."""
+    if orientation not in TRANSPOSE_METHODS:
+        return box
+    inverse = INVERSE.get(orientation, orientation)
+    left, top, right, bottom = box
+    x1, y1 = transpose_point(left, top, displayed_size, inverse)
+    x2, y2 = transpose_point(right, bottom, displayed_size, inverse)
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+
+def transpose_image(pil_image, orientation):
+    """Transpose the image for display.
+
+    Only call this on small images, for example after resizing.
+    """
+    method = TRANSPOSE_METHODS.get(orientation)
+    if method is None:
+        return pil_image
+    return pil_image.transpose(method)
@@ -0,0 +1,121 @@
+"""Multi-resolution pyramid of an original image.
+
+Every scale normally resamples from the full-size original,
+even for a small thumbnail of a huge photo.
+When the FOCALPOINTS_PYRAMID option is on, we store reduced versions
+of the original next to the field, each half the size of the previous one:
+
+    field_value.pyramid = [half, quarter, eighth, ...]
+
+Each level is an image of the same class as the original.
+When scaling, we pick the smallest level that is still large enough.
+Focal points stay in the coordinates of the original.
+Levels keep the raw pixels and EXIF orientation of the original,
+so we compare sizes in displayed coordinates.
+"""
+from .. import config
+from ..limiter import heavy_operation
+from ..limiter import Saturated
+from .orientation import get_displayed_size
+from .orientation import get_orientation
+from .orientation import ORIENTATION_TAG
+from .orientation import swap_size
+from io import BytesIO
+
+import logging
+import PIL.Image
+
+
+logger = logging.getLogger(__name__)
+
+
+def make_pyramid(field_value, pil_image):
+    """Create the pyramid levels for this image field value.
+
+    This does not change the field value.  Returns a list of levels,
+    or None when the option is off or the image is too small.
+    """
+    if not config.PYRAMID:
+        return
+    try:
+        with heavy_operation("pyramid"):
+            return make_levels(field_value, pil_image)
+    except Saturated:
+        # The levels are optional.  Scaling uses the original.
+        logger.warning("Too busy to create pyramid levels.  Skipping.")
+
+
+def make_levels(field_value, pil_image):
+    """Create the pyramid levels.  Returns a list, or None when too small."""
+    format_ = pil_image.format
+    save_options = {"quality": 90, "icc_profile": pil_image.info.get("icc_profile")}
+    orientation = get_orientation(pil_image)
+    if orientation != 1:
+        # Levels keep the raw pixels, like the original,
+        # so they need the same orientation.
+        exif = PIL.Image.Exif()
+        exif[ORIENTATION_TAG] = orientation
+        save_options["exif"] = exif.tobytes()
+    if format_ not in ("PNG", "GIF"):
+        format_ = "JPEG"
+    else:
+        # Keep transparency.
+        format_ = "PNG"
+    if format_ == "JPEG" and pil_image.mode not in ("RGB", "L", "CMYK"):
+        pil_image = pil_image.convert("RGB")
+    elif pil_image.mode in ("P", "1"):
+        # Resizing these modes is not smooth.
+        pil_image = pil_image.convert("RGBA")
+    levels = []
+    width, height = pil_image.size
+    while min(width, height) // 2 >= config.PYRAMID_MIN_SIZE:
+        width, height = width // 2, height // 2
+        # Each level is created from the previous one.
+        pil_image = pil_image.resize((width, height), PIL.Image.ANTIALIAS)
+        result = BytesIO()
+        pil_image.save(result, format_, **save_options)
+        # Set the data after creating the level: the constructor of
+        # NamedImage and NamedBlobImage rotates images with an orientation.
+        level = field_value.__class__(filename=field_value.filename)
+        level.data = result.getvalue()
+        levels.append(level)
+    logger.debug("Created %d pyramid levels.", len(levels))
+    return levels or None
+
+
+def get_pyramid_level(field_value, width=None, height=None, mode="contain"):
+    """Get the smallest pyramid level that is large enough for this scale.
+
+    Returns None when there is no pyramid or no level is small enough to help.
+    Mode 'scale' fits the image within width and height.
+    The other modes scale until both width and height are covered,
+    and crop the rest.
+    """
+    pyramid = getattr(field_value, "pyramid", None)
+    if not pyramid:
+        return
+    # The width and height are in displayed coordinates.
+    orientation = getattr(field_value, "orientation", 1)
+    original_width, original_height = get_displayed_size(field_value, orientation)
+    if not original_width or not original_height:
+        return
+    factors = []
+    if width:
+        factors.append(int(width) / original_width)
+    if height:
+        factors.append(int(height) / original_height)
+    if not factors:
+        return
+    if mode == "scale":
+        factor = min(factors)
+    else:
+        factor = max(factors)
+    needed_width = original_width * factor
+    needed_height = original_height * factor
+    found = None
+    for level in pyramid:
+        level_width, level_height = swap_size((level._width, level._height), orientation)
+        if level_width < needed_width or level_height < needed_height:
+            break
+        found = level
+    return found
@@ -0,0 +1,460 @@
+"""Share decoded originals between the Zope processes on one host.
+
+With several Zope instances behind a load balancer, a popular original
+gets decoded in every process.  With FOCALPOINTS_SHARED_CACHE_MB set,
+the first process that decodes it, copies the pixels into a segment
+of multiprocessing.shared_memory.  Other processes wrap that segment
+as PIL image, without decoding and without copying.
+
+- The key is the sha256 digest of the image data, so it does not matter
+  which instance or site the image comes from.
+- The index of all segments is a JSON file in FOCALPOINTS_SHARED_CACHE_DIR.
+  We only lock it to add or remove entries, not to get an image.
+  All processes that want to share, must use the same directory,
+  and the same budget.
+- Each process writes which images it currently uses, and when it last
+  used them, in its own file in the 'uses' directory.  When the total size
+  goes over the budget, we remove the least recently used entries that no
+  living process uses.
+- An RGB image is shared as RGBX, which is how Pillow keeps it in memory.
+  Other modes than L, RGB, RGBA and CMYK are not shared.
+
+Shared images are read-only: Pillow copies them before changing them.
+This needs fcntl and Python 3.8, so it is off on Windows and Python 3.7.
+"""
+from .. import config
+from collections import deque
+from contextlib import contextmanager
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import PIL.Image
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
+
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+INDEX_NAME = "index.json"
+LOCK_NAME = "index.lock"
+USES_NAME = "uses"
+# Remember the last use of at most this many images that we no longer use.
+MAX_OLD_USES = 1000
+# Image mode and the raw mode in which we share it.
+MODES = {"L": "L", "RGB": "RGBX", "RGBA": "RGBA", "CMYK": "CMYK"}
+# Image info that we share, as long as it is not too big.
+INFO_KEYS = ("icc_profile", "exif")
+MAX_INFO_SIZE = 65536
+# The segment starts with the length of the JSON header.
+LENGTH = struct.Struct("<I")
+# The pixels start at a multiple of this.
+ALIGN = 64
+# multiprocessing.shared_memory is new in Python 3.8.  We only import it
+# when the cache is on, so the package still works on 3.7.
+HAS_SHARED_MEMORY = sys.version_info >= (3, 8)
+# Since Python 3.13 SharedMemory can leave out the resource tracker.
+CAN_UNTRACK = sys.version_info >= (3, 13)
+# The cache of this process, see get_shared_cache.
+_cache = None
+_cache_lock = threading.Lock()
+# Segments that we could not close yet, see SharedImageCache.close.
+_unclosed = []
+
+
+def open_segment(name, create=False, size=0):
+    """Open a shared memory segment that outlives this process.
+
+    By default the resource tracker of multiprocessing removes segments
+    when the process that uses them stops.
+    """
+    from multiprocessing import resource_tracker
+    from multiprocessing import shared_memory
+
+    if CAN_UNTRACK:
+        return shared_memory.SharedMemory(
+            name=name, create=create, size=size, track=False
+        )
+    # We cannot switch this off, only undo it.
+    segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+def unlink_segment(name):
+    """Remove a segment.  Processes that still have it open can use it."""
+    from multiprocessing import resource_tracker
+
+    try:
+        segment = open_segment(name)
+    except FileNotFoundError:
+        return
+    if not CAN_UNTRACK:
+        # unlink tells the resource tracker that the segment is gone,
+        # so we must tell it about the segment first.
+        resource_tracker.register(segment._name, "shared_memory")
+    segment.unlink()
+    segment.close()
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, but belongs to someone else.
+        return True
+    return True
+
+
+def is_shared(pil_image):
+    """Is this image a view on a shared memory segment?"""
+    return getattr(pil_image, "shared_digest", None) is not None
+
+
+def make_header(pil_image, raw_mode):
+    info = {}
+    for key in INFO_KEYS:
+        value = pil_image.info.get(key)
+        if isinstance(value, bytes) and len(value) <= MAX_INFO_SIZE:
+            info[key] = base64.b64encode(value).decode("ascii")
+    header = {
+        "mode": raw_mode,
+        "size": list(pil_image.size),
+        "format": pil_image.format,
+        "info": info,
+    }
+    return json.dumps(header).encode("utf-8")
+
+
+class SegmentUse:
+    """Kept on a shared image, to know when the image is gone.
+
+    A finalizer on the image itself runs too early: Pillow still holds
+    the pixels then.  Attributes of the image are released after its pixels.
+    """
+
+
+def get_offset(header_length):
+    return -(-(LENGTH.size + header_length) // ALIGN) * ALIGN
+
+
+class SharedImageCache:
+    """Decoded images in shared memory, by digest, with a host-wide budget."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, INDEX_NAME)
+        self.lock_path = os.path.join(directory, LOCK_NAME)
+        self.uses_directory = os.path.join(directory, USES_NAME)
+        os.makedirs(self.uses_directory, exist_ok=True)
+        # Caches with another directory use other segments.
+        self.prefix = "fp" + hashlib.sha1(directory.encode()).hexdigest()[:6]
+        # The images that this process uses: digest -> [count, last use].
+        self.uses = {}
+        self.uses_lock = threading.Lock()
+        # Digests of shared images that are gone, see release.
+        self.released = deque()
+
+    def get_name(self, digest):
+        # macOS allows at most 31 characters.
+        return f"{self.prefix}_{digest[:20]}"
+
+    @contextmanager
+    def locked(self):
+        """Lock the index of the host.  Yields the index."""
+        self.handle_released()
+        # flock is per open file, so this also locks out other threads.
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield self.read_index()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_index(self):
+        """Read the index.  It is replaced as a whole, so this needs no lock."""
+        try:
+            with open(self.index_path) as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+
+    def write_index(self, index):
+        temp_path = f"{self.index_path}.{os.getpid()}"
+        with open(temp_path, "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(temp_path, self.index_path)
+
+    def write_uses(self):
+        """Write the use file of this process.  Call this with the uses lock."""
+        # Forget the oldest images that we no longer use.
+        old = sorted(
+            (use[1], digest) for digest, use in self.uses.items() if use[0] <= 0
+        )
+        for _used, digest in old[: max(len(old) - MAX_OLD_USES, 0)]:
+            del self.uses[digest]
+        path = os.path.join(self.uses_directory, str(os.getpid()))
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as uses_file:
+            json.dump(self.uses, uses_file)
+        os.replace(temp_path, path)
+
+    def change_uses(self, changes):
+        """Change the counts of the images that this process uses."""
+        now = time.time()
+        with self.uses_lock:
+            for digest, change in changes.items():
+                count = self.uses.get(digest, (0, now))[0] + change
+                self.uses[digest] = [max(count, 0), now]
+            self.write_uses()
+
+    def read_uses(self):
+        """Read the use files of the living processes, and remove the others.
+
+        Returns the digests of the images that are in use,
+        and a dictionary with the last use of each digest.
+        """
+        in_use = set()
+        last_used = {}
+        for name in os.listdir(self.uses_directory):
+            if not name.isdigit():
+                continue
+            path = os.path.join(self.uses_directory, name)
+            if not is_alive(int(name)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                with open(path) as uses_file:
+                    uses = json.load(uses_file)
+            except (OSError, ValueError):
+                continue
+            for digest, (count, used) in uses.items():
+                if count > 0:
+                    in_use.add(digest)
+                last_used[digest] = max(last_used.get(digest, 0), used)
+        return in_use, last_used
+
+    def handle_released(self):
+        """Stop using the images that are gone, see release."""
+        changes = {}
+        while self.released:
+            try:
+                digest = self.released.popleft()
+            except IndexError:
+                break
+            changes[digest] = changes.get(digest, 0) - 1
+        if changes:
+            self.change_uses(changes)
+
+    def get(self, digest):
+        """Get the shared image with this digest, or None."""
+        self.handle_released()
+        entry = self.read_index().get(digest)
+        if entry is None or not entry["ready"]:
+            return
+        try:
+            segment = open_segment(entry["name"])
+        except FileNotFoundError:
+            # Removed since we read the index.
+            return
+        # When another process removes the segment now, we can still use it.
+        self.change_uses({digest: 1})
+        try:
+            return self.wrap(digest, segment)
+        except Exception:
+            logger.exception("Could not use shared image %s", digest)
+            self.close(segment)
+            self.change_uses({digest: -1})
+
+    def wrap(self, digest, segment):
+        """Wrap the segment as a read-only PIL image."""
+        (length,) = LENGTH.unpack_from(segment.buf, 0)
+        header = json.loads(bytes(segment.buf[LENGTH.size : LENGTH.size + length]))
+        mode = header["mode"]
+        size = tuple(header["size"])
+        offset = get_offset(length)
+        pixels = segment.buf[
+            offset : offset + size[0] * size[1] * PIL.Image.getmodebands(mode)
+        ]
+        pil_image = PIL.Image.frombuffer(mode, size, pixels, "raw", mode, 0, 1)
+        pil_image.format = header["format"]
+        for key, value in header["info"].items():
+            pil_image.info[key] = base64.b64decode(value)
+        pil_image.shared_digest = digest
+        # When the image is gone, we stop using the segment.
+        pil_image.shared_use = SegmentUse()
+        weakref.finalize(pil_image.shared_use, self.release, digest, segment, pixels)
+        return pil_image
+
+    def close(self, segment, pixels=None):
+        """Close the segment, or try again later when it is still in use."""
+        try:
+            if pixels is not None:
+                pixels.release()
+            segment.close()
+        except BufferError:
+            # Something still points to the pixels.
+            _unclosed.append((segment, pixels))
+            return
+        for item in _unclosed[:]:
+            try:
+                if item[1] is not None:
+                    item[1].release()
+                item[0].close()
+            except BufferError:
+                continue
+            try:
+                _unclosed.remove(item)
+            except ValueError:
+                # Closed by a finalizer in between.
+                pass
+
+    def release(self, digest, segment, pixels=None):
+        """Stop using a shared image that is gone.
+
+        This runs in a finalizer, at any moment, also while this thread
+        holds one of our locks.  So we only close the segment here,
+        and count the release on the next call of get or locked.
+        """
+        self.close(segment, pixels)
+        self.released.append(digest)
+
+    def put(self, digest, pil_image):
+        """Share the decoded image.  Returns True when it is shared now."""
+        raw_mode = MODES.get(pil_image.mode)
+        if raw_mode is None or is_shared(pil_image):
+            return False
+        header = make_header(pil_image, raw_mode)
+        offset = get_offset(len(header))
+        width, height = pil_image.size
+        pixel_size = width * height * PIL.Image.getmodebands(raw_mode)
+        size = offset + pixel_size
+        if size > self.max_bytes:
+            return False
+        name = self.get_name(digest)
+        with self.locked() as index:
+            if digest in index or not self.make_room(index, size):
+                return False
+            try:
+                segment = open_segment(name, create=True, size=size)
+            except FileExistsError:
+                # Left behind by a crashed process.
+                unlink_segment(name)
+                segment = open_segment(name, create=True, size=size)
+            # Reserve it.  Others ignore it until it is ready.
+            index[digest] = {
+                "name": name,
+                "size": size,
+                "used": time.time(),
+                "ready": False,
+                "pid": os.getpid(),
+            }
+            self.write_index(index)
+        # Copy the pixels without holding the lock.
+        try:
+            LENGTH.pack_into(segment.buf, 0, len(header))
+            segment.buf[LENGTH.size : LENGTH.size + len(header)] = header
+            segment.buf[offset:size] = pil_image.tobytes("raw", raw_mode)
+        except Exception:
+            segment.close()
+            self.remove(digest, name)
+            raise
+        segment.close()
+        with self.locked() as index:
+            entry = index.get(digest)
+            if entry is None or entry["name"] != name:
+                return False
+            entry["ready"] = True
+            self.write_index(index)
+        logger.debug("Shared decoded image %s of %d bytes.", digest, size)
+        return True
+
+    def get_unused(self, index):
+        """Get (last use, digest) of the entries that nobody uses."""
+        in_use, last_used = self.read_uses()
+        unused = []
+        for digest, entry in index.items():
+            if digest in in_use:
+                continue
+            if not entry["ready"] and is_alive(entry["pid"]):
+                # Still being filled.
+                continue
+            unused.append((max(entry["used"], last_used.get(digest, 0)), digest))
+        return unused
+
+    def make_room(self, index, size):
+        """Remove unused entries until this size fits in the budget.
+
+        When it does not fit, even without the unused entries,
+        we remove nothing and return False.
+        """
+        total = sum(entry["size"] for entry in index.values())
+        if total + size <= self.max_bytes:
+            return True
+        remove = []
+        for _used, digest in sorted(self.get_unused(index)):
+            if total + size <= self.max_bytes:
+                break
+            remove.append(digest)
+            total -= index[digest]["size"]
+        if total + size > self.max_bytes:
+            return False
+        for digest in remove:
+            entry = index.pop(digest)
+            unlink_segment(entry["name"])
+        return True
+
+    def remove(self, digest, name):
+        with self.locked() as index:
+            entry = index.get(digest)
+            if entry is not None and entry["name"] == name:
+                del index[digest]
+                self.write_index(index)
+        unlink_segment(name)
+
+    def clear(self):
+        """Remove all unused entries."""
+        with self.locked() as index:
+            for _used, digest in self.get_unused(index):
+                entry = index.pop(digest)
+                unlink_segment(entry["name"])
+            self.write_index(index)
+
+    def stats(self):
+        """Return the number of entries, their bytes, and the budget."""
+        index = self.read_index()
+        return {
+            "entries": len(index),
+            "bytes": sum(entry["size"] for entry in index.values()),
+            "max_bytes": self.max_bytes,
+        }
+
+
+def get_shared_cache():
+    """Get the shared cache of the host, or None when it is off."""
+    global _cache
+    if config.SHARED_CACHE_MB <= 0 or fcntl is None or not HAS_SHARED_MEMORY:
+        return
+    with _cache_lock:
+        if _cache is None:
+            directory = config.SHARED_CACHE_DIR or os.path.join(
+                tempfile.gettempdir(), "experimental.focalpoints.shared"
+            )
+            _cache = SharedImageCache(directory, config.SHARED_CACHE_MB * 1024 * 1024)
+        return _cache
@@ -1,7 +1,14 @@
 # from .interfaces import IImageTransformer
+from .. import config
+from .blobs import open_image_file
+from .decoded import get_decoded_image
+from .decoded import remember_decoded_image
 from .interfaces import IWantImageTransforming
 from .transformer import OriginalFocalPointsTransformer
+from .utils import compute_focalpoint_changes
 from .utils import determine_focalpoint_for_image
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from plone.dexterity.utils import iterSchemata
 from plone.namedfile.interfaces import INamedImageField
 from zope.component import adapter
@@ -10,17 +17,17 @@ from zope.lifecycleevent.interfaces import IObjectModifiedEvent
 from zope.schema import getFieldsInOrder
 
 import logging
+import threading
 
 
 logger = logging.getLogger(__name__)
+# Shared by all requests, so the number of detection threads is bounded.
+_pool = None
+_pool_lock = threading.Lock()
 
 
-def get_image_field_values(obj, first=False):
-    """Get all image fields values.
-
-    When 'first' is True, we return the first one.
-    This can be useful in code wants to know if any image field is filled.
-    """
+def get_image_fields(obj):
+    """Get (fieldname, value) for all filled image fields."""
     fields = []
     for schema in iterSchemata(obj):
         adapter = schema(obj)
@@ -28,21 +35,66 @@ def get_image_field_values(obj, first=False):
             if INamedImageField.providedBy(field):
                 value = getattr(adapter, name)
                 if value:
-                    if first:
-                        return value
-                    fields.append(value)
+                    fields.append((name, value))
+    return fields
+
+
+def get_image_field_values(obj, first=False):
+    """Get all image fields values.
+
+    When 'first' is True, we return the first one.
+    This can be useful in code wants to know if any image field is filled.
+    """
+    fields = [value for name, value in get_image_fields(obj)]
+    if first:
+        return fields[0] if fields else []
     return fields
 
 
+def get_pool():
+    """Get the thread pool for detection on several image fields."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=config.DETECTION_THREADS,
+                thread_name_prefix="focalpoints-detection",
+            )
+        return _pool
+
+
 def determine_focalpoints(obj):
     # Gather all image fields.
     field_values = get_image_field_values(obj)
     if not field_values:
         return
-    # Future: use getAdapters on IImageTransformer to get all.
-    transformer = OriginalFocalPointsTransformer(obj)
-    for field_value in field_values:
-        determine_focalpoint_for_image(field_value, transformer=transformer)
+    if len(field_values) == 1 or config.DETECTION_THREADS <= 1:
+        # Future: use getAdapters on IImageTransformer to get all.
+        transformer = OriginalFocalPointsTransformer(obj)
+        for field_value in field_values:
+            determine_focalpoint_for_image(field_value, transformer=transformer)
+        return
+    # Decoding and detection mostly release the GIL, so we can do the fields
+    # at the same time.  The threads only compute.  We open the blobs and
+    # change the fields here, in the thread that owns the ZODB connection.
+    with ExitStack() as stack:
+        jobs = []
+        for field_value in field_values:
+            transformer = OriginalFocalPointsTransformer(obj)
+            transformer.prepare(field_value, "original")
+            if not transformer.available:
+                continue
+            image = get_decoded_image(field_value)
+            if image is None:
+                image = stack.enter_context(open_image_file(field_value))
+            future = get_pool().submit(compute_focalpoint_changes, image, transformer)
+            jobs.append((field_value, transformer, future))
+        for field_value, transformer, future in jobs:
+            changes, pil_image = future.result()
+            if pil_image is not None:
+                remember_decoded_image(field_value, pil_image)
+            if changes:
+                transformer.apply(changes)
 
 
 @adapter(IWantImageTransforming, IObjectAddedEvent)
@@ -6,11 +6,20 @@ Licensed under the MIT license:
 http://www.opensource.org/licenses/mit-license
 Copyright (c) 2011 globo.com thumbor@googlegroups.com
 """
-from .detectors import FeatureFocalpointDetector
+from .. import config
+from .detectors import get_detector_class
+from .orientation import get_orientation
+from .orientation import swap_size
+from .orientation import transpose_image
+from .orientation import transpose_point
+from .orientation import untranspose_box
+from .pyramid import make_pyramid
+from .window import get_window_offset
 
 import logging
 import math
 import PIL.Image
+import time
 
 
 # from .interfaces import IImageTransformer
@@ -54,26 +63,71 @@ class OriginalFocalPointsTransformer(BaseImageTransformer):
     """Determine focalpoints on the original while saving an image."""
 
     def handle_original(self, pil_image, **kwargs):
+        self.apply(self.compute(pil_image))
+
+    def compute(self, pil_image):
+        """Compute the new field attributes, without changing the field.
+
+        This does the heavy work, so it can run in another thread.
+        Returns a dictionary with attribute names and values.
+        """
+        changes = self.determine_focal_point(pil_image)
+        # Reduced versions of the original, if this option is on.
+        changes["pyramid"] = make_pyramid(self.field, pil_image)
+        return changes
+
+    def apply(self, changes):
+        """Store the computed attributes on the field."""
+        for name, value in changes.items():
+            if value is None and getattr(self.field, name, None) is None:
+                # Do not add an empty attribute.
+                continue
+            setattr(self.field, name, value)
+
+    def determine_focal_point(self, pil_image, **detector_options):
+        """Determine the focal point.
+
+        The detector options override the defaults of the detector class,
+        for example detection_size.
+        Returns a dictionary with the new focal point attributes of the field.
+        """
+        # Remember when we did this, for example for catalog metadata.
+        changes = {"focal_point_date": time.time()}
+        # The detectors work on the raw pixels,
+        # but we store the focal point in displayed coordinates.
+        orientation = get_orientation(pil_image)
+        changes["orientation"] = orientation if orientation != 1 else None
         # Adapted mostly from transformer.do_smart_detection
         focal_points = []
         # Future: call named adapters that determine various focal points,
         # for example one for features, one for faces.
         # order does not matter here
         # for name, handler in getAdapters((obj,), IFocalPointDetector):
-        for handler in (FeatureFocalpointDetector(self.context),):
+        for handler in (get_detector_class()(self.context, **detector_options),):
             found = handler(pil_image)
             if found:
                 focal_points.extend(found)
         if not focal_points:
             # Clear a previously determined focal point.
             logger.debug("No focal points found.")
-            self.field.focal_point = None
-            return
+            changes["focal_point"] = None
+            changes["focal_points"] = None
+            return changes
         logger.debug("Found focal points: %r", focal_points)
+        if orientation != 1:
+            for focal_point in focal_points:
+                focal_point.x, focal_point.y = transpose_point(
+                    focal_point.x, focal_point.y, pil_image.size, orientation
+                )
         focal_x, focal_y = self.get_center_of_mass(focal_points)
         logger.debug("Center of mass: %d, %d", focal_x, focal_y)
-        # Save the focal point information on the field.
-        self.field.focal_point = (focal_x, focal_y)
+        # The focal point information for the field.
+        changes["focal_point"] = (focal_x, focal_y)
+        # Keep the separate points too, for the 'window' crop strategy.
+        changes["focal_points"] = [
+            (round(point.x), round(point.y), point.weight) for point in focal_points
+        ]
+        return changes
 
     def get_center_of_mass(self, focal_points):
         # From transformer.get_center_of_mass
@@ -164,7 +218,88 @@ class CropFocalPointsTransformer(BaseImageTransformer):
         target_width = int(target_width) or 1
         target_height = int(target_height) or 1
 
-        source_width, source_height = pil_image.size
+        orientation = get_orientation(pil_image)
+        box = self.get_crop_box(pil_image.size, target_width, target_height, orientation)
+        if box is None:
+            if orientation == 1:
+                return
+            # No cropping needed, but we still need to transpose.
+            box = (0, 0) + pil_image.size
+
+        logger.debug(f"Cropping image: {box}")
+        pil_image = pil_image.crop(box)
+        # Now resize.  We still work on raw pixels, so we may need to swap the size.
+        raw_size = swap_size((target_width, target_height), orientation)
+        logger.debug(f"Resizing image to {raw_size[0]}x{raw_size[1]}")
+        pil_image.draft(pil_image.mode, raw_size)
+        # Resize creates a new image.
+        new_image = pil_image.resize(raw_size, PIL.Image.ANTIALIAS)
+        # Transposing the small result is cheap.
+        return transpose_image(new_image, orientation)
+
+    def get_focal_point(self, source_size, orientation=1):
+        """Get the focal point in the coordinates of the source image.
+
+        The focal point is determined on the original.  The source image
+        may be smaller, for example a pyramid level, so we scale the point.
+        Source size and focal point are in displayed coordinates.
+        The field has the raw size, so we may need to swap it.
+        """
+        focal_x, focal_y = self.field.focal_point
+        source_width, source_height = source_size
+        original_width, original_height = swap_size(
+            (getattr(self.field, "_width", None), getattr(self.field, "_height", None)),
+            orientation,
+        )
+        original_width = original_width or source_width
+        original_height = original_height or source_height
+        return (
+            focal_x * source_width / original_width,
+            focal_y * source_height / original_height,
+        )
+
+    def get_feature_points(self, source_size, orientation=1):
+        """Get the stored feature points in the coordinates of the source image.
+
+        Like get_focal_point, but for all (x, y, weight) points.
+        Fields where focal points were determined by an older version
+        do not have them: then we return an empty list.
+        """
+        points = getattr(self.field, "focal_points", None) or []
+        source_width, source_height = source_size
+        original_width, original_height = swap_size(
+            (getattr(self.field, "_width", None), getattr(self.field, "_height", None)),
+            orientation,
+        )
+        x_factor = source_width / (original_width or source_width)
+        y_factor = source_height / (original_height or source_height)
+        return [(x * x_factor, y * y_factor, weight) for x, y, weight in points]
+
+    def get_window_offset(
+        self, displayed_size, length, horizontal, preferred, orientation=1
+    ):
+        """Get the offset of the most interesting window, or None.
+
+        Only when the 'window' crop strategy is configured.  See window.py.
+        """
+        if config.CROP_STRATEGY != "window":
+            return
+        points = self.get_feature_points(displayed_size, orientation)
+        return get_window_offset(points, displayed_size, length, horizontal, preferred)
+
+    def get_crop_box(self, source_size, target_width, target_height, orientation=1):
+        """Get the crop box (left, top, right, bottom) around the focal point.
+
+        This only does math, so it can be used to determine one box
+        and use it for several target sizes with the same aspect ratio.
+        Returns None when the source already has the target aspect ratio.
+
+        The source size and the box are in raw pixel coordinates.
+        The target size is in displayed coordinates.
+        See the orientation module.
+        """
+        displayed_size = swap_size(source_size, orientation)
+        source_width, source_height = displayed_size
 
         source_ratio = round(source_width / source_height, 2)
         target_ratio = round(target_width / target_height, 2)
@@ -172,11 +307,11 @@ class CropFocalPointsTransformer(BaseImageTransformer):
         if source_ratio == target_ratio:
             return
 
-        focal_x, focal_y = self.field.focal_point
+        focal_x, focal_y = self.get_focal_point(displayed_size, orientation)
         if target_width / source_width > target_height / source_height:
             # We can keep the entire source width during cropping.
             crop_left = 0
-            crop_right = crop_width = source_width
+            crop_right = source_width
             crop_height = int(round(source_width * target_height / target_width, 0))
             crop_top = int(
                 round(
@@ -186,12 +321,17 @@ class CropFocalPointsTransformer(BaseImageTransformer):
                     )
                 )
             )
+            window_top = self.get_window_offset(
+                displayed_size, crop_height, False, crop_top, orientation
+            )
+            if window_top is not None:
+                crop_top = window_top
             crop_bottom = min(crop_top + crop_height, source_height)
         else:
             # We can keep the entire source height during cropping.
             # Note to self: top left corner is at (0, 0).
             crop_top = 0
-            crop_bottom = crop_height = source_height
+            crop_bottom = source_height
             crop_width = int(
                 round(
                     math.ceil(target_width * source_height / target_height),
@@ -206,15 +346,12 @@ class CropFocalPointsTransformer(BaseImageTransformer):
                     )
                 )
             )
+            window_left = self.get_window_offset(
+                displayed_size, crop_width, True, crop_left, orientation
+            )
+            if window_left is not None:
+                crop_left = window_left
             crop_right = min(crop_left + crop_width, source_width)
 
-        logger.debug(
-            f"Cropping image: {crop_left}, {crop_top}, {crop_right}, {crop_bottom}"
-        )
-        pil_image = pil_image.crop((crop_left, crop_top, crop_right, crop_bottom))
-        # Now resize.
-        logger.debug(f"Resizing image to {target_width}x{target_height}")
-        pil_image.draft(pil_image.mode, (target_width, target_height))
-        # Resize creates a new image.
-        new_image = pil_image.resize((target_width, target_height), PIL.Image.ANTIALIAS)
-        return new_image
+        box = (crop_left, crop_top, crop_right, crop_bottom)
+        return untranspose_box(box, displayed_size, orientation)
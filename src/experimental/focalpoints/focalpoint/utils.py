@@ -1,4 +1,11 @@
+from .. import config
+from ..limiter import Saturated
+from ..profiling import profile
+from .blobs import open_image_file
+from .decoded import get_decoded_image
+from .decoded import remember_decoded_image
 from .transformer import OriginalFocalPointsTransformer
+from plone.protect.utils import safeWrite
 
 import logging
 import PIL.Image
@@ -19,13 +26,81 @@ def determine_focalpoint_for_image(field_value, transformer=None, context=None):
     transformer.prepare(field_value, "original")
     if not transformer.available:
         return
-    with field_value.open() as image_file:
+    pil_image = get_decoded_image(field_value)
+    if pil_image is not None:
+        changes, pil_image = compute_focalpoint_changes(pil_image, transformer)
+    else:
+        with open_image_file(field_value) as image_file:
+            changes, pil_image = compute_focalpoint_changes(image_file, transformer)
+        if pil_image is not None:
+            # Detection has decoded the image.  Scales may want it too.
+            remember_decoded_image(field_value, pil_image)
+    if changes:
+        transformer.apply(changes)
+
+
+def needs_lazy_detection(field_value):
+    """Should we determine the focal point of this image on its first crop?
+
+    Only when the option is on, and detection never ran on this image.
+    An image on which detection found nothing, has a focal_point_date too,
+    so we do not try again on every crop.
+    """
+    if not config.LAZY_DETECTION or field_value is None:
+        return False
+    return getattr(field_value, "focal_point_date", None) is None
+
+
+def determine_focalpoint_lazily(field_value, pil_image, context=None):
+    """Determine the focal point on an image that was decoded for a crop.
+
+    We only store the focal point attributes.  Pyramid levels are left to
+    a full detection, and catalog metadata is updated on the next reindex.
+    """
+    if context is None:
+        context = field_value
+    transformer = OriginalFocalPointsTransformer(context)
+    transformer.prepare(field_value, "original")
+    if not transformer.available:
+        return
+    options = {}
+    if config.LAZY_DETECTION_SIZE > 0:
+        options["detection_size"] = config.LAZY_DETECTION_SIZE
+    try:
+        with profile("determine_focalpoint", context, pil_image.size):
+            changes = transformer.determine_focal_point(pil_image, **options)
+    except Saturated:
+        # Try again on a next crop.
+        logger.warning("Too busy to determine focal point for %s", context)
+        return
+    transformer.apply(changes)
+    # This usually happens in a GET request.  Like the scale storage,
+    # tell plone.protect that this write is fine.
+    safeWrite(field_value)
+
+
+def compute_focalpoint_changes(image, transformer):
+    """Compute the focal point changes with a prepared transformer.
+
+    The image is an open image file or an already decoded PIL image.
+    This does not change the field value, so it can run in another thread.
+    Returns a dictionary of attribute changes or None, and the PIL image.
+    """
+    if isinstance(image, PIL.Image.Image):
+        pil_image = image
+    else:
         try:
-            pil_image = PIL.Image.open(image_file)
+            pil_image = PIL.Image.open(image)
         except OSError:
             # Probably: cannot identify image file
             # Locally I have experimental.gracefulblobmissing,
             # so image blobs may be wrong.
             logger.warning("OSError opening image file at %s", transformer.context)
-            return
-        transformer.run(pil_image)
+            return None, None
+    try:
+        with profile("determine_focalpoint", transformer.context, pil_image.size):
+            return transformer.compute(pil_image), pil_image
+    except Saturated:
+        # Keep any previous focal point.
+        logger.warning("Too busy to determine focal point for %s", transformer.context)
+        return None, pil_image
@@ -0,0 +1,65 @@
+"""Admission control for heavy image operations.
+
+OpenCV and Pillow work runs in every Zope thread at the same time,
+and OpenCV starts its own threads on top of that.
+With several instances per machine this means heavy oversubscription,
+and a few slow images can starve the whole instance.
+
+With FOCALPOINTS_MAX_CONCURRENT set, at most that many heavy operations
+run at the same time in this process.  Others wait in line for at most
+FOCALPOINTS_QUEUE_TIMEOUT seconds.  After that we raise Saturated,
+and the caller falls back to something cheaper, or skips the work.
+Scaling falls back to standard scaling, which waits in line for at most
+FOCALPOINTS_FALLBACK_TIMEOUT seconds.
+"""
+from . import config
+from contextlib import contextmanager
+
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+if config.MAX_CONCURRENT > 0:
+    _semaphore = threading.BoundedSemaphore(config.MAX_CONCURRENT)
+else:
+    _semaphore = None
+# Keep track of threads that already have a slot,
+# so nested heavy operations do not wait for themselves.
+_local = threading.local()
+
+
+class Saturated(Exception):
+    """Too many heavy image operations are running."""
+
+
+@contextmanager
+def heavy_operation(name="image operation", timeout=None):
+    """Run the code in this context when there is a free slot.
+
+    Raises Saturated when no slot became free within the timeout.
+    By default this is the FOCALPOINTS_QUEUE_TIMEOUT.
+    """
+    if timeout is None:
+        timeout = config.QUEUE_TIMEOUT
+    depth = getattr(_local, "depth", 0)
+    if _semaphore is None or depth:
+        _local.depth = depth + 1
+        try:
+            yield
+        finally:
+            _local.depth = depth
+        return
+    if not _semaphore.acquire(timeout=timeout):
+        logger.warning(
+            "Waited %s seconds for a free slot for %s. Giving up.",
+            timeout,
+            name,
+        )
+        raise Saturated(name)
+    _local.depth = 1
+    try:
+        yield
+    finally:
+        _local.depth = 0
+        _semaphore.release()
@@ -0,0 +1,320 @@
+"""Concurrent load test for image scaling on a test Plone site.
+
+Microbenchmarks miss lock contention, annotation conflicts
+and thread starvation.  This tool sets up the test layer from testing.py,
+creates Image items with synthetic photo-like originals,
+and fires concurrent scale requests from several threads,
+each with its own ZODB connection, like Zope worker threads.
+
+Scales are requested in two ways:
+
+- content: the @@images view of the Image,
+  which ends up in ExperimentalImageScalingFactory,
+- tile: TileImageScaling for a persistent tile with an image field,
+  when plone.app.tiles is available.
+
+There are two phases:
+
+- cold: every scale is requested once, so every request creates a scale,
+- warm: every scale is requested again, a few times, so they come from storage.
+
+For each phase and path we report latency percentiles, throughput,
+and the number of ConflictErrors and other errors.
+
+Run it with the test extra installed:
+
+    bin/focalpoints-loadtest --images 20 --threads 8
+"""
+from .synthetic import make_image_data
+from .testing import EXPERIMENTAL_FOCALPOINTS_FIXTURE
+
+import argparse
+import logging
+import math
+import queue
+import random
+import threading
+import time
+import transaction
+
+
+logger = logging.getLogger(__name__)
+TILE_NAME = "experimental.focalpoints.loadtest"
+DEFAULT_SIZES = ((1200, 675), (800, 450), (400, 400), (200, 150))
+DEFAULT_DIRECTIONS = ("contain", "scale")
+
+
+def setup_layer(layer, done):
+    """Set up the layer and its bases, like the zope testrunner does."""
+    for base in layer.__bases__:
+        setup_layer(base, done)
+    if layer not in done:
+        layer.setUp()
+        done.append(layer)
+
+
+def teardown_layers(done):
+    for layer in reversed(done):
+        try:
+            layer.tearDown()
+        except NotImplementedError:
+            pass
+
+
+def open_app(db):
+    """Open a connection and return the app root with a request."""
+    from Testing.makerequest import makerequest
+
+    connection = db.open()
+    app = makerequest(connection.root()["Application"])
+    return connection, app
+
+
+def get_portal(app):
+    from plone.app.testing import PLONE_SITE_ID
+    from zope.component.hooks import setSite
+    from zope.globalrequest import setRequest
+
+    portal = app[PLONE_SITE_ID]
+    setSite(portal)
+    setRequest(app.REQUEST)
+    return portal
+
+
+def close_app(connection):
+    from zope.component.hooks import setSite
+    from zope.globalrequest import clearRequest
+
+    setSite(None)
+    clearRequest()
+    connection.close()
+
+
+def get_tile(context, request, tile_id):
+    from plone.tiles.tile import PersistentTile
+
+    tile = PersistentTile(context, request)
+    tile.__name__ = TILE_NAME
+    tile.id = tile_id
+    return tile
+
+
+def create_content(db, count, width, height, with_tiles):
+    """Create Image items, with focal points.  Returns list of ids."""
+    from .focalpoint.subscriber import determine_focalpoints
+    from .focalpoint.utils import determine_focalpoint_for_image
+    from plone.app.testing import login
+    from plone.app.testing import SITE_OWNER_NAME
+    from plone.namedfile.file import NamedBlobImage
+
+    connection, app = open_app(db)
+    ids = []
+    try:
+        login(app["acl_users"], SITE_OWNER_NAME)
+        portal = get_portal(app)
+        for index in range(count):
+            data, _subjects = make_image_data(width, height, seed=index, subjects=2)
+            image_id = f"loadtest-image-{index}"
+            portal.invokeFactory(
+                "Image",
+                image_id,
+                title=f"Load test image {index}",
+                image=NamedBlobImage(data, filename=f"{image_id}.jpg"),
+            )
+            obj = portal[image_id]
+            # Without z3c.form, we need to call this ourselves.
+            determine_focalpoints(obj)
+            if with_tiles:
+                from plone.tiles.interfaces import ITileDataManager
+
+                value = NamedBlobImage(data, filename=f"{image_id}.jpg")
+                determine_focalpoint_for_image(value, context=obj)
+                tile = get_tile(obj, app.REQUEST, "tile-1")
+                ITileDataManager(tile).set({"image": value})
+            ids.append(image_id)
+            transaction.commit()
+    finally:
+        close_app(connection)
+    return ids
+
+
+def scale(db, job):
+    """Request one scale in a new connection.  Returns the outcome."""
+    from zope.component import getMultiAdapter
+    from ZODB.POSException import ConflictError
+
+    path, image_id, width, height, direction = job
+    connection, app = open_app(db)
+    try:
+        portal = get_portal(app)
+        obj = portal[image_id]
+        request = app.REQUEST
+        if path == "tile":
+            from .tilescaling import TileImageScaling
+
+            tile = get_tile(obj, request, "tile-1")
+            view = TileImageScaling(tile, request)
+        else:
+            view = getMultiAdapter((obj, request), name="images")
+        info = view.scale("image", width=width, height=height, direction=direction)
+        transaction.commit()
+        if info is None:
+            return "error"
+        return "ok"
+    except ConflictError:
+        transaction.abort()
+        return "conflict"
+    except Exception:
+        transaction.abort()
+        logger.exception("Error scaling %r", job)
+        return "error"
+    finally:
+        close_app(connection)
+
+
+def run_phase(db, jobs, threads):
+    """Run the jobs with this many threads.
+
+    Returns the elapsed time and a list of (path, duration, outcome) results.
+    """
+    job_queue = queue.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    results = []
+    results_lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                job = job_queue.get_nowait()
+            except queue.Empty:
+                return
+            start = time.perf_counter()
+            outcome = scale(db, job)
+            duration = time.perf_counter() - start
+            with results_lock:
+                results.append((job[0], duration, outcome))
+
+    workers = [threading.Thread(target=worker) for _index in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start, results
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    index = max(math.ceil(percent / 100 * len(values)) - 1, 0)
+    return values[index]
+
+
+def report(phase, elapsed, results):
+    lines = []
+    for path in sorted(set(result[0] for result in results)):
+        path_results = [result for result in results if result[0] == path]
+        durations = sorted(result[1] * 1000 for result in path_results)
+        outcomes = [result[2] for result in path_results]
+        lines.append(
+            "{:<5} {:<8} {:>6} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>9} {:>6}".format(
+                phase,
+                path,
+                len(path_results),
+                percentile(durations, 50),
+                percentile(durations, 95),
+                percentile(durations, 99),
+                len(path_results) / elapsed,
+                outcomes.count("conflict"),
+                outcomes.count("error"),
+            )
+        )
+    return lines
+
+
+def parse_sizes(value):
+    sizes = []
+    for size in value.split(","):
+        width, height = size.lower().split("x")
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Concurrent load test for image scaling on a test Plone site."
+    )
+    parser.add_argument("--images", type=int, default=10, help="Number of images.")
+    parser.add_argument(
+        "--original-size",
+        type=parse_sizes,
+        default=[(3000, 2000)],
+        help="Size of the originals, for example 3000x2000.",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=parse_sizes,
+        default=list(DEFAULT_SIZES),
+        help="Comma separated scale sizes, for example 800x450,400x400.",
+    )
+    parser.add_argument("--threads", type=int, default=4, help="Concurrent threads.")
+    parser.add_argument(
+        "--warm-repeat",
+        type=int,
+        default=3,
+        help="How often each scale is requested in the warm phase.",
+    )
+    parser.add_argument(
+        "--no-tiles", action="store_true", help="Do not test the tile path."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed for shuffling.")
+    options = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    with_tiles = not options.no_tiles
+    if with_tiles:
+        try:
+            import plone.app.tiles  # noqa: F401
+            import plone.tiles  # noqa: F401
+        except ImportError:
+            print("plone.app.tiles is not available: skipping the tile path.")
+            with_tiles = False
+
+    done = []
+    setup_layer(EXPERIMENTAL_FOCALPOINTS_FIXTURE, done)
+    try:
+        db = EXPERIMENTAL_FOCALPOINTS_FIXTURE["zodbDB"]
+        width, height = options.original_size[0]
+        print(f"Creating {options.images} images of {width}x{height}...")
+        ids = create_content(db, options.images, width, height, with_tiles)
+        paths = ["content"]
+        if with_tiles:
+            paths.append("tile")
+        jobs = [
+            (path, image_id, scale_width, scale_height, direction)
+            for path in paths
+            for image_id in ids
+            for scale_width, scale_height in options.sizes
+            for direction in DEFAULT_DIRECTIONS
+        ]
+        shuffler = random.Random(options.seed)
+        shuffler.shuffle(jobs)
+        print(
+            "phase path      count   p50 ms   p95 ms   p99 ms    req/s conflicts errors"
+        )
+        elapsed, results = run_phase(db, jobs, options.threads)
+        for line in report("cold", elapsed, results):
+            print(line)
+        warm_jobs = jobs * options.warm_repeat
+        shuffler.shuffle(warm_jobs)
+        elapsed, results = run_phase(db, warm_jobs, options.threads)
+        for line in report("warm", elapsed, results):
+            print(line)
+    finally:
+        teardown_layers(done)
+
+
+if __name__ == "__main__":
+    main()
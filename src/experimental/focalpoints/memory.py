@@ -0,0 +1,304 @@
+"""Peak memory of focal point detection and scaling, per stage.
+
+A small change, like an extra copy of the gray scale image during
+detection, or an extra copy of the encoded scale, can silently double
+the memory use for large originals.  This script measures the peak memory
+of each stage for large synthetic JPEG and PNG originals, and compares it
+with a budget relative to the number of pixels of the original.
+
+Stages:
+
+- decode: open the original and load all pixels,
+- detect: feature detection on the decoded image, with the configured detector,
+- crop: crop around the focal point and resize, see CropFocalPointsTransformer,
+- create_scale: the focal point scaling of our scaling factory, from the
+  encoded original to the scale encoded into a file.  This needs Plone.
+
+Each measurement runs in a fresh Python process, so stages do not
+share memory that was freed but not given back to the operating system.
+We measure two things:
+
+- traced: peak of memory allocated by Python and NumPy, with tracemalloc,
+- rss: peak of the resident set size, sampled every few milliseconds
+  from /proc (Linux only).  This includes the memory of Pillow and OpenCV.
+
+Both are reported in bytes per pixel of the original.  The tests in
+tests/test_memory.py check the budgets on originals of 12, 24 and 50
+megapixels.  For other sizes, run the script.  When a stage goes over its budget,
+it exits with status 1:
+
+    bin/focalpoints-memory --megapixels 12 24 50 --format JPEG PNG
+"""
+from .synthetic import make_image_data
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+
+STAGES = ("decode", "detect", "crop", "create_scale")
+# Budget per stage in bytes per pixel of the original: (traced, rss).
+# Pillow keeps a decoded RGB image in 4 bytes per pixel.
+BUDGETS = {
+    "decode": (0.5, 5.0),
+    "crop": (0.5, 5.5),
+    "create_scale": (0.5, 10.0),
+}
+# Detection depends a lot on the detector.  OpenCV works on the full
+# image in several float32 copies: we measured 2.0 traced and 35 rss.
+# The NumPy detector reduces it first.
+DETECT_BUDGETS = {
+    "opencv": (2.5, 40.0),
+    "numpy": (1.0, 2.0),
+}
+DEFAULT_MEGAPIXELS = (12, 24, 50)
+DEFAULT_FORMATS = ("JPEG", "PNG")
+# Size of the scale in the crop and create_scale stages.
+SCALE_SIZE = (1200, 675)
+SAMPLE_INTERVAL = 0.002
+# For running a stage in a fresh process.  Not __name__: that is __main__
+# when this runs as script.
+MODULE = "experimental.focalpoints.memory"
+
+
+def get_rss():
+    """Get the resident set size of this process in bytes, or None."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return
+
+
+class RSSSampler:
+    """Sample the resident set size in a thread and remember the peak."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = self.baseline = get_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.sample)
+        self._thread.daemon = True
+
+    def sample(self):
+        while not self._stop.is_set():
+            rss = get_rss()
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        if self.baseline is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        rss = get_rss()
+        if rss is not None and self.peak is not None and rss > self.peak:
+            self.peak = rss
+
+    @property
+    def increase(self):
+        if self.baseline is None:
+            return
+        return self.peak - self.baseline
+
+
+def get_field(size):
+    """Get a field value stand-in with the focal point in the center."""
+    from .benchmark import FieldStub
+
+    return FieldStub(size, (size[0] // 2, size[1] // 2))
+
+
+def prepare_stage(stage, data):
+    """Prepare the input of a stage.  Returns a function that runs the stage."""
+    from io import BytesIO
+
+    import PIL.Image
+
+    def open_image():
+        return PIL.Image.open(BytesIO(data))
+
+    if stage == "decode":
+        return lambda: open_image().load()
+    if stage == "detect":
+        from .focalpoint.detectors import get_detector_class
+
+        detector = get_detector_class()(None)
+        pil_image = open_image()
+        pil_image.load()
+        return lambda: detector(pil_image)
+    if stage == "crop":
+        from .focalpoint.transformer import CropFocalPointsTransformer
+
+        pil_image = open_image()
+        pil_image.load()
+        transformer = CropFocalPointsTransformer(None)
+        transformer.prepare(get_field(pil_image.size), "contain")
+        return lambda: transformer.run(
+            pil_image, target_width=SCALE_SIZE[0], target_height=SCALE_SIZE[1]
+        )
+    if stage == "create_scale":
+        from .focalpoint.transformer import CropFocalPointsTransformer
+        from .scaling import ExperimentalImageScalingFactory
+
+        factory = ExperimentalImageScalingFactory(None)
+        factory.fieldname = "image"
+        transformer = CropFocalPointsTransformer(None)
+        transformer.prepare(get_field(open_image().size), "contain")
+        # Like the blob file of the new scale, see create_scale_value.
+        result = tempfile.TemporaryFile()
+        return lambda: factory.create_focal_scale(
+            transformer,
+            data,
+            "contain",
+            SCALE_SIZE[1],
+            SCALE_SIZE[0],
+            result=result,
+        )
+    raise ValueError(f"Unknown stage {stage!r}")
+
+
+def measure_stage(stage, path):
+    """Measure one stage on the image in this file, in this process."""
+    import PIL.Image
+
+    with open(path, "rb") as image_file:
+        data = image_file.read()
+    pixels = PIL.Image.open(path).size
+    pixels = pixels[0] * pixels[1]
+    run = prepare_stage(stage, data)
+    tracemalloc.start()
+    with RSSSampler() as sampler:
+        start = time.perf_counter()
+        run()
+        duration = time.perf_counter() - start
+    traced = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "pixels": pixels,
+        "traced": traced,
+        "rss": sampler.increase,
+        "seconds": duration,
+    }
+
+
+def measure(stage, path):
+    """Measure one stage in a fresh process."""
+    # A test runner or buildout script may have set up the path itself.
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.check_output(
+        [sys.executable, "-m", MODULE, "--stage", stage, path], env=env
+    )
+    return json.loads(output)
+
+
+def write_original(directory, megapixels, format_):
+    """Write a synthetic original in landscape 3:2.  Returns the path."""
+    height = int((megapixels * 1000000 / 1.5) ** 0.5)
+    width = int(height * 1.5)
+    data, _subjects = make_image_data(
+        width, height, seed=megapixels, format_=format_, subjects=2
+    )
+    path = os.path.join(directory, f"{megapixels}.{format_.lower()}")
+    with open(path, "wb") as image_file:
+        image_file.write(data)
+    return path
+
+
+def get_budget(stage):
+    """Get the (traced, rss) budget in bytes per pixel for this stage."""
+    if stage != "detect":
+        return BUDGETS[stage]
+    from .focalpoint.detectors import DETECTORS
+    from .focalpoint.detectors import get_detector_class
+
+    detector_class = get_detector_class()
+    for name, klass in DETECTORS.items():
+        if klass is detector_class:
+            return DETECT_BUDGETS[name]
+
+
+def check(stage, result):
+    """Return the names of the budgets that this result goes over."""
+    traced_budget, rss_budget = get_budget(stage)
+    over = []
+    if result["traced"] > traced_budget * result["pixels"]:
+        over.append("traced")
+    if result["rss"] is not None and result["rss"] > rss_budget * result["pixels"]:
+        over.append("rss")
+    return over
+
+
+def format_line(megapixels, format_, stage, result, over):
+    pixels = result["pixels"]
+    rss = "-" if result["rss"] is None else f"{result['rss'] / pixels:.2f}"
+    return (
+        f"{megapixels:>4} {format_:<5} {stage:<13} "
+        f"{result['traced'] / pixels:>7.2f} {rss:>7} "
+        f"{result['seconds']:>8.2f}  {', '.join(over) or 'ok'}"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Peak memory of focal point detection and scaling, per stage."
+    )
+    parser.add_argument(
+        "--megapixels",
+        type=int,
+        nargs="+",
+        default=list(DEFAULT_MEGAPIXELS),
+        help="Sizes of the originals in megapixels.",
+    )
+    parser.add_argument(
+        "--format",
+        nargs="+",
+        default=list(DEFAULT_FORMATS),
+        choices=DEFAULT_FORMATS,
+        help="Formats of the originals.",
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        default=list(STAGES),
+        choices=STAGES,
+        help="Stages to measure.",
+    )
+    # Used internally to measure one stage in a fresh process.
+    parser.add_argument("--stage", choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument("path", nargs="?", help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    if options.stage:
+        print(json.dumps(measure_stage(options.stage, options.path)))
+        return
+
+    print("  MP format stage         traced     rss  seconds  budget")
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        for megapixels in options.megapixels:
+            for format_ in options.format:
+                path = write_original(directory, megapixels, format_)
+                for stage in options.stages:
+                    result = measure(stage, path)
+                    over = check(stage, result)
+                    failed = failed or bool(over)
+                    print(format_line(megapixels, format_, stage, result, over))
+    if failed:
+        print("Some stages go over their memory budget.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""Capture profiles of slow scale and detection operations.
+
+This is off unless FOCALPOINTS_PROFILE_DIR is set.  Then a profile is captured:
+
+- when a Manager adds ?focalpoints-profile=1 to the request,
+- or when a previous operation on the same image took longer than
+  FOCALPOINTS_PROFILE_THRESHOLD seconds.  Then we profile the next one.
+  These captures happen at most once per FOCALPOINTS_PROFILE_INTERVAL seconds.
+
+We do not profile every operation and only keep the slow ones,
+because tracemalloc slows down all threads while it runs.
+Only one capture runs at the same time.
+
+For each capture we write two files to the profile directory:
+
+- a .prof file that you can inspect with pstats or snakeviz,
+- a .txt file with url, image size, duration, peak memory and the top functions.
+"""
+from . import config
+from AccessControl import getSecurityManager
+from contextlib import contextmanager
+from zope.globalrequest import getRequest
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+
+
+logger = logging.getLogger(__name__)
+REQUEST_PARAMETER = "focalpoints-profile"
+# Remember at most this many slow images.
+MAX_SLOW_KEYS = 100
+_capture_lock = threading.Lock()
+_state_lock = threading.Lock()
+_slow_keys = set()
+_last_capture = 0.0
+
+
+def get_url(context):
+    try:
+        return context.absolute_url()
+    except AttributeError:
+        return repr(context)
+
+
+def is_requested(context):
+    """Did a Manager ask for a profile in the request?"""
+    request = getRequest()
+    if request is None or not request.get(REQUEST_PARAMETER):
+        return False
+    return bool(getSecurityManager().checkPermission("Manage portal", context))
+
+
+def should_capture(key, context):
+    global _last_capture
+    if is_requested(context):
+        return True
+    with _state_lock:
+        if key not in _slow_keys:
+            return False
+        if time.time() - _last_capture < config.PROFILE_INTERVAL:
+            return False
+        _slow_keys.discard(key)
+        _last_capture = time.time()
+        return True
+
+
+def start_capture(key, context):
+    """Take the capture lock when we should capture this operation.
+
+    We take the lock first, so a capture that is already running
+    does not use up the slow key or the interval of this one.
+    """
+    if not _capture_lock.acquire(blocking=False):
+        return False
+    if should_capture(key, context):
+        return True
+    _capture_lock.release()
+    return False
+
+
+def mark_slow(key):
+    with _state_lock:
+        if len(_slow_keys) >= MAX_SLOW_KEYS:
+            return
+        _slow_keys.add(key)
+
+
+@contextmanager
+def profile(name, context, size=None):
+    """Profile the code in this context, when wanted.
+
+    name is the operation, for example 'create_scale'.
+    size is the (width, height) of the original image, if known.
+    """
+    if not config.PROFILE_DIR:
+        yield
+        return
+    url = get_url(context)
+    key = (name, url)
+    if not start_capture(key, context):
+        start = time.time()
+        yield
+        duration = time.time() - start
+        if config.PROFILE_THRESHOLD and duration > config.PROFILE_THRESHOLD:
+            logger.info(
+                "%s took %.2f seconds for %s. Will profile the next one.",
+                name,
+                duration,
+                url,
+            )
+            mark_slow(key)
+        return
+    try:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, "reset_peak"):
+            # Python 3.9+
+            tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        start = time.time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            duration = time.time() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            if started_tracing:
+                tracemalloc.stop()
+            write_profile(profiler, name, url, size, duration, peak)
+    finally:
+        _capture_lock.release()
+
+
+def write_profile(profiler, name, url, size, duration, peak):
+    slug = re.sub(r"[^A-Za-z0-9]+", "-", url.split("://", 1)[-1]).strip("-")[:100]
+    if size:
+        slug = f"{slug}-{size[0]}x{size[1]}"
+    now = time.time()
+    timestamp = "{}-{:03d}".format(
+        time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), int(now * 1000) % 1000
+    )
+    basename = f"{timestamp}-{name}-{slug}"
+    path = os.path.join(config.PROFILE_DIR, basename)
+    try:
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(path + ".prof")
+        stats_output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stats_output)
+        stats.sort_stats("cumulative").print_stats(30)
+        with open(path + ".txt", "w") as info_file:
+            info_file.write(f"Operation: {name}\n")
+            info_file.write(f"URL: {url}\n")
+            if size:
+                info_file.write(f"Image size: {size[0]} x {size[1]}\n")
+            info_file.write(f"Duration: {duration:.3f} seconds\n")
+            info_file.write(f"Peak traced memory: {peak / 1024 / 1024:.1f} MB\n\n")
+            info_file.write(stats_output.getvalue())
+    except OSError:
+        logger.exception("Could not write profile to %s", path)
+        return
+    logger.info("Wrote profile of %s for %s to %s.prof", name, url, path)
@@ -0,0 +1,206 @@
+"""Record which scales are requested.
+
+To size caches and decide which scales to create in advance,
+we need the real mix of scale requests.  With FOCALPOINTS_RECORD_FILE set,
+every scale request is written as one JSON line:
+
+    {"time": 1700000000.0, "call": "scale", "uid": "...", "tile_name": null,
+     "tile_id": null, "field": "image", "width": 1200, "height": 675,
+     "params": {"mode": "contain"}, "result": "miss", "ms": 85.2,
+     "bytes": 152340}
+
+- 'call' is the method of the scale storage: 'scale', 'pre_scale' (image
+  tags and srcsets on Plone 6 prepare a scale) or 'get_or_generate'
+  (a scale url on Plone 6 creates the prepared scale).
+
+- 'tile_name' and 'tile_id' are set for an image in a persistent tile.
+- 'params' are the other scale parameters, like mode and quality,
+  as they were passed.
+- 'result' is 'hit' (from storage), 'miss' (created now), 'stale' (an
+  outdated scale, see the revalidate module), 'prepared' (by pre_scale,
+  created when its url is requested) or 'none' (no scale).
+
+The scale storage records all requests.  For content this needs Plone 6,
+where we override the storage.  Otherwise only misses are recorded,
+by the scaling factory.  The file is rotated after FOCALPOINTS_RECORD_MAX_MB.
+Use one file per Zope instance.  See the replay module for what you can do
+with the recordings.
+"""
+from . import config
+
+import json
+import logging
+import logging.handlers
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+# Parameters that we record separately, or not at all.
+SEPARATE_PARAMETERS = ("fieldname", "width", "height", "factory", "scale")
+# The logger that writes the records.  See get_record_logger.
+_record_logger = None
+_record_logger_lock = threading.Lock()
+# The storage sets a state here while it scales, so the factory can tell
+# that it has created a scale.
+_local = threading.local()
+
+
+def get_record_logger():
+    """Get the logger that writes the records, or None when off."""
+    global _record_logger
+    if not config.RECORD_FILE:
+        return
+    if _record_logger is not None:
+        return _record_logger
+    with _record_logger_lock:
+        if _record_logger is None:
+            handler = logging.handlers.RotatingFileHandler(
+                config.RECORD_FILE,
+                maxBytes=config.RECORD_MAX_MB * 1024 * 1024,
+                backupCount=config.RECORD_BACKUPS,
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            record_logger = logging.getLogger(f"{__name__}.file")
+            record_logger.addHandler(handler)
+            record_logger.setLevel(logging.INFO)
+            # Keep the records out of the event log.
+            record_logger.propagate = False
+            _record_logger = record_logger
+    return _record_logger
+
+
+def get_location(context):
+    """Get (uid, tile name, tile id) of the content item or tile."""
+    from plone.uuid.interfaces import IUUID
+
+    try:
+        from plone.tiles.interfaces import IPersistentTile
+    except ImportError:
+        IPersistentTile = None
+
+    if IPersistentTile is not None and IPersistentTile.providedBy(context):
+        return IUUID(context.context, None), context.__name__, context.id
+    return IUUID(context, None), None, None
+
+
+def get_params(parameters):
+    """Get the parameters that can be written as JSON, except the separate ones."""
+    params = {}
+    for key, value in parameters.items():
+        if key in SEPARATE_PARAMETERS:
+            continue
+        if value is None or isinstance(value, (str, int, float, bool)):
+            params[key] = value
+    return params
+
+
+def make_record(context, call, parameters, result, seconds, size=None):
+    uid, tile_name, tile_id = get_location(context)
+    return {
+        "time": time.time(),
+        "call": call,
+        "uid": uid,
+        "tile_name": tile_name,
+        "tile_id": tile_id,
+        "field": parameters.get("fieldname"),
+        "width": parameters.get("width"),
+        "height": parameters.get("height"),
+        "params": get_params(parameters),
+        "result": result,
+        "ms": round(seconds * 1000, 1),
+        "bytes": size,
+    }
+
+
+def write_record(record):
+    record_logger = get_record_logger()
+    if record_logger is not None:
+        record_logger.info(json.dumps(record, sort_keys=True))
+
+
+def mark_created(context, parameters, seconds):
+    """Tell that the scaling factory has created a scale.
+
+    When a storage records this request, it only needs to know that
+    this was a miss.  Otherwise we record the miss here.
+    """
+    state = getattr(_local, "state", None)
+    if state is not None:
+        state["created"] = True
+        return
+    if get_record_logger() is None:
+        return
+    try:
+        write_record(make_record(context, "scale", parameters, "miss", seconds))
+    except Exception:
+        logger.exception("Could not record scale request.")
+
+
+def get_info_size(info):
+    from .compaction import get_scale_size
+
+    return get_scale_size(info) or None
+
+
+class RecordingMixin:
+    """Mixin for a scale storage to record each scale request."""
+
+    def is_stale(self, info):
+        modified = self.modified() if self.modified is not None else None
+        return bool(modified and info.get("modified") and info["modified"] < modified)
+
+    def get_result(self, info, created, uid=None):
+        if created:
+            return "miss"
+        if info is None:
+            return "none"
+        if info.get("data") is None:
+            return "prepared"
+        if self.is_stale(info) or (uid is not None and info.get("uid") != uid):
+            # The revalidate module serves another scale for this uid.
+            return "stale"
+        return "hit"
+
+    def record_call(self, call, parameters, method, *args, uid=None, **kwargs):
+        """Call the method of the storage and record the result."""
+        from .revalidate import is_revalidating
+
+        if get_record_logger() is None or is_revalidating():
+            return method(*args, **kwargs)
+        previous = getattr(_local, "state", None)
+        state = _local.state = {"created": False}
+        start = time.perf_counter()
+        try:
+            info = method(*args, **kwargs)
+        finally:
+            _local.state = previous
+        seconds = time.perf_counter() - start
+        try:
+            result = self.get_result(info, state["created"], uid=uid)
+            size = None if result in ("none", "prepared") else get_info_size(info)
+            write_record(
+                make_record(self.context, call, parameters, result, seconds, size)
+            )
+        except Exception:
+            logger.exception("Could not record scale request.")
+        return info
+
+    def scale(self, **parameters):
+        return self.record_call("scale", parameters, super().scale, **parameters)
+
+    def pre_scale(self, **parameters):
+        return self.record_call(
+            "pre_scale", parameters, super().pre_scale, **parameters
+        )
+
+    def get_or_generate(self, name):
+        parameters = {}
+        if get_record_logger() is not None:
+            # The parameters of the prepared scale.
+            info = self.get(name)
+            if info is not None and info.get("key"):
+                parameters = self.unhash(info["key"])
+        return self.record_call(
+            "get_or_generate", parameters, super().get_or_generate, name, uid=name
+        )
@@ -0,0 +1,407 @@
+"""Replay recorded scale requests.
+
+Scale requests are recorded with FOCALPOINTS_RECORD_FILE, see the recording
+module.  Pass the files oldest first, for example 'scales.jsonl.2 scales.jsonl.1
+scales.jsonl'.  This script can:
+
+- simulate: replay the requests on scale caches of various sizes,
+  in number of scales or in megabytes, and show the hit rates,
+- pregenerate: list the most requested scales, with their count,
+  in the same format, so you can give it to 'site',
+- site: request the scales on a Plone site, with the configuration
+  of a Zope instance, for example to create scales in advance,
+  or to compare timings before and after a change,
+- offline: create each distinct scale from originals in a directory,
+  without Zope, for benchmarking scaling and encoding changes.
+  The originals are named '<uid>-<field>.<extension>', or
+  '<uid>-<tile id>-<field>.<extension>' for tiles.  Focal points can
+  come from a file made with the focalpoints-transfer script.
+
+Examples:
+
+    bin/focalpoints-replay simulate scales.jsonl --entries 1000 10000 --megabytes 500
+    bin/focalpoints-replay pregenerate scales.jsonl --top 500 --output top.jsonl
+    bin/focalpoints-replay site top.jsonl --zope-conf parts/instance/etc/zope.conf
+    bin/focalpoints-replay offline scales.jsonl --originals originals \\
+        --focal-points focalpoints.jsonl
+"""
+from collections import Counter
+from collections import OrderedDict
+
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+ACTIONS = ("simulate", "pregenerate", "site", "offline")
+DEFAULT_ENTRIES = (100, 1000, 10000)
+# Size of a scale when the recording does not know it.
+DEFAULT_SCALE_BYTES = 100 * 1024
+CROP_MODES = ("contain", "scale-crop-to-fit", "down")
+# Results that do not read a scale from the cache.  A prepared scale
+# is read when its url is requested, which is recorded separately.
+SKIP_SIMULATE = ("none", "prepared")
+# Commit after this many scales when replaying on a site.
+COMMIT_EVERY = 100
+
+
+def read_records(paths):
+    """Yield the records in the files, in order."""
+    for path in paths:
+        with open(path) as record_file:
+            for line in record_file:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning("Skipping invalid line in %s", path)
+
+
+def get_key(record):
+    """Get what identifies the scale of a record."""
+    return (
+        record.get("uid"),
+        record.get("tile_name"),
+        record.get("tile_id"),
+        record.get("field"),
+        record.get("width"),
+        record.get("height"),
+        json.dumps(record.get("params") or {}, sort_keys=True),
+    )
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    index = max(math.ceil(percent / 100 * len(values)) - 1, 0)
+    return values[index]
+
+
+def format_timings(durations):
+    durations = sorted(duration * 1000 for duration in durations)
+    return "p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms, total {:.1f} s".format(
+        percentile(durations, 50),
+        percentile(durations, 95),
+        percentile(durations, 99),
+        sum(durations) / 1000,
+    )
+
+
+class LRUCache:
+    """Simulated scale cache, with a budget in entries or in bytes."""
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+
+    def request(self, key, size):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return
+        self.misses += 1
+        self.entries[key] = size
+        self.size += size
+        while self.entries and (
+            (self.max_entries and len(self.entries) > self.max_entries)
+            or (self.max_bytes and self.size > self.max_bytes)
+        ):
+            _key, removed = self.entries.popitem(last=False)
+            self.size -= removed
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def simulate(records, entries=DEFAULT_ENTRIES, megabytes=()):
+    """Replay the records on simulated caches.  Returns report lines."""
+    caches = [(f"{count} scales", LRUCache(max_entries=count)) for count in entries]
+    caches.extend(
+        (f"{size} MB", LRUCache(max_bytes=size * 1024 * 1024)) for size in megabytes
+    )
+    caches.append(("unlimited", LRUCache()))
+    results = Counter()
+    sizes = {}
+    for record in records:
+        results[record.get("result")] += 1
+        if record.get("result") in SKIP_SIMULATE:
+            continue
+        key = get_key(record)
+        if record.get("bytes"):
+            sizes[key] = record["bytes"]
+        size = sizes.get(key, DEFAULT_SCALE_BYTES)
+        for _name, cache in caches:
+            cache.request(key, size)
+    total = sum(results.values())
+    lines = [
+        f"Requests: {total}, "
+        + ", ".join(f"{name}: {count}" for name, count in sorted(results.items())),
+        "",
+        f"{'cache':<16} {'hit rate':>9} {'misses':>8}",
+    ]
+    for name, cache in caches:
+        lines.append(f"{name:<16} {cache.hit_rate:>9.1%} {cache.misses:>8}")
+    return lines
+
+
+def pregenerate(records, top=None):
+    """Get the most requested scales, as records with a count."""
+    counts = Counter()
+    first = {}
+    for record in records:
+        if record.get("result") == "none" or not record.get("uid"):
+            continue
+        key = get_key(record)
+        counts[key] += 1
+        first.setdefault(key, record)
+    scales = []
+    for key, count in counts.most_common(top):
+        record = first[key]
+        scale = {
+            name: record.get(name)
+            for name in ("uid", "tile_name", "tile_id", "field", "width", "height")
+        }
+        scale["params"] = record.get("params") or {}
+        scale["count"] = count
+        scales.append(scale)
+    return scales
+
+
+def get_scaling_view(site, record, cache):
+    """Get the images view for the content item or tile of the record."""
+    from Products.CMFCore.utils import getToolByName
+    from zope.component import getMultiAdapter
+    from zope.component import queryMultiAdapter
+
+    uid = record.get("uid")
+    if uid not in cache:
+        catalog = getToolByName(site, "portal_catalog")
+        brains = catalog.unrestrictedSearchResults(UID=uid)
+        cache[uid] = brains[0]._unrestrictedGetObject() if brains else None
+    obj = cache[uid]
+    if obj is None:
+        return
+    request = site.REQUEST
+    if not record.get("tile_name"):
+        return getMultiAdapter((obj, request), name="images")
+    from .tilescaling import TileImageScaling
+
+    tile = queryMultiAdapter((obj, request), name=record["tile_name"])
+    if tile is None:
+        return
+    tile.__name__ = record["tile_name"]
+    tile.id = record["tile_id"]
+    return TileImageScaling(tile, request)
+
+
+def replay_site(site, records, commit_every=COMMIT_EVERY):
+    """Request the scales on the site.  Returns report lines."""
+    import transaction
+
+    outcomes = Counter()
+    durations = []
+    objects = {}
+    pending = 0
+    for record in records:
+        if record.get("result") == "none":
+            continue
+        view = get_scaling_view(site, record, objects)
+        if view is None:
+            outcomes["missing"] += 1
+            continue
+        start = time.perf_counter()
+        try:
+            info = view.scale(
+                record.get("field"),
+                width=record.get("width"),
+                height=record.get("height"),
+                **(record.get("params") or {}),
+            )
+        except Exception:
+            logger.exception("Error scaling %r", record)
+            outcomes["error"] += 1
+            transaction.abort()
+            continue
+        durations.append(time.perf_counter() - start)
+        outcomes["ok" if info is not None else "none"] += 1
+        pending += 1
+        if pending >= commit_every:
+            transaction.commit()
+            pending = 0
+    transaction.commit()
+    return [
+        ", ".join(f"{name}: {count}" for name, count in sorted(outcomes.items())),
+        format_timings(durations),
+    ]
+
+
+def find_original(directory, record):
+    """Find the original image file of the record, or None."""
+    parts = [record.get("uid")]
+    if record.get("tile_id"):
+        parts.append(record["tile_id"])
+    parts.append(record.get("field"))
+    if None in parts:
+        return
+    pattern = os.path.join(directory, glob.escape("-".join(parts)) + ".*")
+    paths = sorted(glob.glob(pattern))
+    return paths[0] if paths else None
+
+
+def read_focal_points(path):
+    """Read focal points from a file made with focalpoints-transfer."""
+    focal_points = {}
+    for record in read_records([path]):
+        key = (record.get("uid"), record.get("tile"), record.get("field"))
+        focal_points[key] = record.get("focal_point")
+    return focal_points
+
+
+def get_target_size(size, width, height):
+    """Fill in a missing width or height from the aspect ratio of the original."""
+    if width and height:
+        return int(width), int(height)
+    if width:
+        return int(width), max(round(int(width) * size[1] / size[0]), 1)
+    if height:
+        return max(round(int(height) * size[0] / size[1]), 1), int(height)
+    return size
+
+
+def create_offline_scale(path, record, focal_point):
+    """Decode, scale and encode one original.  Returns the encoded size."""
+    from .benchmark import FieldStub
+    from .encoder import encode
+    from .focalpoint.transformer import CropFocalPointsTransformer
+
+    import PIL.Image
+
+    params = record.get("params") or {}
+    pil_image = PIL.Image.open(path)
+    format_ = "PNG" if pil_image.format in ("PNG", "GIF") else "JPEG"
+    size = get_target_size(pil_image.size, record.get("width"), record.get("height"))
+    mode = params.get("mode") or params.get("direction") or "thumbnail"
+    transformer = CropFocalPointsTransformer(None)
+    transformer.prepare(FieldStub(pil_image.size, focal_point), "contain")
+    new_image = None
+    if mode in CROP_MODES and transformer.available:
+        # This returns None when no cropping is needed.
+        new_image = transformer.run(
+            pil_image, target_width=size[0], target_height=size[1]
+        )
+    if new_image is None:
+        # Like standard Plone: keep the aspect ratio, without cropping.
+        pil_image.thumbnail(size, PIL.Image.ANTIALIAS)
+    else:
+        pil_image = new_image
+    if format_ == "JPEG" and pil_image.mode not in ("RGB", "L", "CMYK"):
+        pil_image = pil_image.convert("RGB")
+    return len(encode(pil_image, format_, params.get("quality", 88)))
+
+
+def replay_offline(records, directory, focal_points_path=None):
+    """Create each distinct scale once from the originals.  Returns report lines."""
+    focal_points = {}
+    if focal_points_path:
+        focal_points = read_focal_points(focal_points_path)
+    seen = set()
+    durations = []
+    outcomes = Counter()
+    total_bytes = 0
+    for record in records:
+        key = get_key(record)
+        if record.get("result") == "none" or key in seen:
+            continue
+        seen.add(key)
+        path = find_original(directory, record)
+        if path is None:
+            outcomes["missing"] += 1
+            continue
+        focal_point = focal_points.get(
+            (record.get("uid"), record.get("tile_id"), record.get("field"))
+        )
+        start = time.perf_counter()
+        try:
+            total_bytes += create_offline_scale(path, record, focal_point)
+        except Exception:
+            logger.exception("Error scaling %s for %r", path, record)
+            outcomes["error"] += 1
+            continue
+        durations.append(time.perf_counter() - start)
+        outcomes["ok"] += 1
+    return [
+        ", ".join(f"{name}: {count}" for name, count in sorted(outcomes.items())),
+        format_timings(durations),
+        f"Encoded: {total_bytes / 1024 / 1024:.1f} MB",
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded scale requests.")
+    parser.add_argument("action", choices=ACTIONS)
+    parser.add_argument("paths", nargs="+", help="Recordings, oldest first.")
+    parser.add_argument(
+        "--entries",
+        type=int,
+        nargs="*",
+        default=list(DEFAULT_ENTRIES),
+        help="simulate: cache sizes in number of scales.",
+    )
+    parser.add_argument(
+        "--megabytes",
+        type=int,
+        nargs="*",
+        default=[],
+        help="simulate: cache sizes in megabytes.",
+    )
+    parser.add_argument("--top", type=int, help="pregenerate: only this many scales.")
+    parser.add_argument("--output", help="pregenerate: file instead of stdout.")
+    parser.add_argument("--zope-conf", help="site: path to zope.conf.")
+    parser.add_argument("--site", default="Plone", help="site: path of the site.")
+    parser.add_argument("--originals", help="offline: directory with originals.")
+    parser.add_argument(
+        "--focal-points", help="offline: focal points from focalpoints-transfer."
+    )
+    options = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    records = read_records(options.paths)
+    if options.action == "simulate":
+        lines = simulate(records, options.entries, options.megabytes)
+    elif options.action == "pregenerate":
+        output = open(options.output, "w") if options.output else sys.stdout
+        try:
+            for scale in pregenerate(records, options.top):
+                output.write(json.dumps(scale, sort_keys=True) + "\n")
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        return
+    elif options.action == "site":
+        if not options.zope_conf:
+            parser.error("site needs --zope-conf")
+        from .transfer import get_site
+
+        lines = replay_site(get_site(options.zope_conf, options.site), records)
+    else:
+        if not options.originals:
+            parser.error("offline needs --originals")
+        lines = replay_offline(records, options.originals, options.focal_points)
+    print("\n".join(lines))
+
+
+if __name__ == "__main__":
+    main()
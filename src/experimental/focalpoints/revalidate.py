@@ -0,0 +1,257 @@
+"""Stale-while-revalidate for focal point crop scales.
+
+When an image is replaced, or its focal point is determined again,
+the modification time changes and the scale storage throws away all scales.
+The next visitor of each scale waits for a new decode and crop.
+
+With FOCALPOINTS_STALE_MAX_AGE set to a number of seconds, a request for
+an outdated crop scale (mode 'contain') gets the previous scale,
+and a background thread creates the new one.  It does this with the
+standard storage code in its own transaction, so the new scale replaces
+the old one in a single commit.  After the maximum age, counted from the
+modification, we no longer serve the old scale, but create the new one
+in the request, like standard Plone does.
+
+On Plone 6 this also works for image tags and srcsets, which only prepare
+a scale, and for the scale urls in them, which create the prepared scale
+when it is first requested.
+
+This works for tiles, and for content on Plone 6, where the scale storage
+is an adapter that we can override.
+"""
+from . import config
+from .recording import RecordingMixin
+from Acquisition import aq_base
+from plone.scale.scale import get_scale_mode
+from plone.scale.storage import AnnotationStorage
+from ZODB.POSException import ConflictError
+from zope.component import getMultiAdapter
+from zope.component import queryMultiAdapter
+from zope.component.hooks import getSite
+
+import logging
+import queue
+import threading
+import time
+import transaction
+
+
+try:
+    from plone.tiles.interfaces import IPersistentTile
+except ImportError:
+    IPersistentTile = None
+
+logger = logging.getLogger(__name__)
+# Scales waiting to be created in the background.  When this is full,
+# scales are created in the request.
+MAX_PENDING = 100
+_queue = queue.Queue(maxsize=MAX_PENDING)
+_pending = set()
+_pending_lock = threading.Lock()
+_worker = None
+# Set in the background thread, so we create the scale instead of
+# serving the stale one again.
+_local = threading.local()
+
+
+def is_revalidating():
+    return getattr(_local, "active", False)
+
+
+def get_job_location(context):
+    """Get what the background thread needs to find the context again.
+
+    Returns (database, site path, content path, tile name, tile id) or None.
+    """
+    site = getSite()
+    if site is None:
+        return
+    tile_name = tile_id = None
+    content = context
+    if IPersistentTile is not None and IPersistentTile.providedBy(context):
+        # The tile is found by name and id on the content item.
+        tile_name = context.__name__
+        tile_id = context.id
+        content = context.context
+    jar = getattr(aq_base(content), "_p_jar", None)
+    if jar is None:
+        # Not committed yet.
+        return
+    return (
+        jar.db(),
+        site.getPhysicalPath(),
+        content.getPhysicalPath(),
+        tile_name,
+        tile_id,
+    )
+
+
+def schedule(context, parameters):
+    """Schedule creating this scale in the background.
+
+    Returns False when this is not possible.
+    """
+    location = get_job_location(context)
+    if location is None:
+        return False
+    key = location[2:] + (repr(sorted(parameters.items())),)
+    with _pending_lock:
+        if key in _pending:
+            # Already scheduled.
+            return True
+        try:
+            _queue.put_nowait((key, location, dict(parameters)))
+        except queue.Full:
+            return False
+        _pending.add(key)
+        start_worker()
+    return True
+
+
+def start_worker():
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    _worker = threading.Thread(target=work, name="focalpoints-revalidate")
+    _worker.daemon = True
+    _worker.start()
+
+
+def work():
+    while True:
+        key, location, parameters = _queue.get()
+        try:
+            revalidate(location, parameters)
+        except Exception:
+            logger.exception("Error creating scale %r in the background.", key)
+        finally:
+            with _pending_lock:
+                _pending.discard(key)
+
+
+def revalidate(location, parameters):
+    """Create the scale in a new connection and commit it."""
+    from Testing.makerequest import makerequest
+    from zope.component.hooks import setSite
+    from zope.globalrequest import clearRequest
+    from zope.globalrequest import setRequest
+
+    database, site_path, content_path, tile_name, tile_id = location
+    connection = database.open()
+    _local.active = True
+    try:
+        app = makerequest(connection.root()["Application"])
+        request = app.REQUEST
+        site = app.unrestrictedTraverse(site_path)
+        setSite(site)
+        setRequest(request)
+        obj = app.unrestrictedTraverse(content_path)
+        if tile_name is None:
+            view = getMultiAdapter((obj, request), name="images")
+        else:
+            from .tilescaling import TileImageScaling
+
+            tile = queryMultiAdapter((obj, request), name=tile_name)
+            if tile is None:
+                return
+            tile.__name__ = tile_name
+            tile.id = tile_id
+            view = TileImageScaling(tile, request)
+        view.scale(**parameters)
+        transaction.commit()
+    except ConflictError:
+        # Someone else changed the scales.  The next request tries again.
+        transaction.abort()
+        logger.info("Conflict creating scale of %s in the background.", content_path)
+    except Exception:
+        transaction.abort()
+        raise
+    finally:
+        _local.active = False
+        setSite(None)
+        clearRequest()
+        connection.close()
+
+
+def get_hash_parameters(parameters):
+    """Get the parameters that identify a scale."""
+    # Older versions accept a deprecated factory.
+    return {key: value for key, value in parameters.items() if key != "factory"}
+
+
+class StaleWhileRevalidateMixin:
+    """Mixin for a scale storage to serve stale crop scales for a while."""
+
+    def get_stale_info(self, parameters, modified=None):
+        """Get the info of an outdated scale that we may still serve.
+
+        The modification time is in milliseconds, by default that of the
+        storage.  Returns None when there is no such scale, or there is
+        an up to date one, or it is too old, or it is not a crop.
+        """
+        mode = parameters.get("mode") or parameters.get("direction") or "thumbnail"
+        if get_scale_mode(mode) != "contain":
+            return
+        if modified is None and self.modified is not None:
+            modified = self.modified()
+        if not modified:
+            return
+        if time.time() - modified / 1000 > config.STALE_MAX_AGE:
+            return
+        key = self.hash(**parameters)
+        stale = None
+        for info in self.storage.values():
+            # Prepared scales have no data yet.
+            if info.get("key") != key or info.get("data") is None:
+                continue
+            if not info.get("modified"):
+                continue
+            if info["modified"] >= modified:
+                return
+            if stale is None or info["modified"] > stale["modified"]:
+                stale = info
+        return stale
+
+    def serve_stale(self, parameters, modified=None):
+        """Get an outdated scale to serve, and create the new one in the
+        background.  Returns None when we cannot do this.
+        """
+        if config.STALE_MAX_AGE <= 0 or is_revalidating():
+            return
+        info = self.get_stale_info(parameters, modified=modified)
+        if info is None or not schedule(self.context, parameters):
+            return
+        logger.debug("Serving stale scale %s while creating a new one.", info["uid"])
+        return info
+
+    def scale(self, **parameters):
+        info = self.serve_stale(get_hash_parameters(parameters))
+        if info is None:
+            return super().scale(**parameters)
+        return info
+
+    def pre_scale(self, **parameters):
+        info = self.serve_stale(get_hash_parameters(parameters))
+        if info is None:
+            return super().pre_scale(**parameters)
+        return info
+
+    def get_or_generate(self, name):
+        info = self.get(name)
+        if info is None or info.get("data") is not None:
+            return super().get_or_generate(name)
+        # A scale that pre_scale has prepared.  Here the storage has no
+        # modification time.  The scale was prepared because there was
+        # no scale for the current modification time, so we use its time:
+        # scales with the same parameters and data are older.
+        parameters = self.unhash(info["key"])
+        stale = self.serve_stale(parameters, modified=info.get("modified"))
+        if stale is None:
+            return super().get_or_generate(name)
+        return stale
+
+
+class RevalidatingAnnotationStorage(
+    RecordingMixin, StaleWhileRevalidateMixin, AnnotationStorage
+):
+    """Annotation storage for scales of content items."""
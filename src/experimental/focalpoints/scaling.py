@@ -47,22 +47,33 @@ We want to start with improving syncrecipe images,
 and the recipe_view.pt used direction=down, so mode=contain.
 
 """
+from . import config
+from .encoder import encode
+from .focalpoint.blobs import open_image_data
+from .focalpoint.decoded import get_decoded_image
+from .focalpoint.decoded import remember_decoded_image
+from .focalpoint.pyramid import get_pyramid_level
 from .focalpoint.transformer import CropFocalPointsTransformer
-from Acquisition import aq_base
+from .focalpoint.utils import determine_focalpoint_lazily
+from .focalpoint.utils import needs_lazy_detection
+from .limiter import heavy_operation
+from .limiter import Saturated
+from .profiling import profile
+from .recording import mark_created
+from .srcset import get_srcset_batch
 from io import BytesIO
-from plone.namedfile.file import FILECHUNK_CLASSES
 from plone.namedfile.scaling import DefaultImageScalingFactory
 from plone.rfc822.interfaces import IPrimaryFieldInfo
 from plone.scale.interfaces import IImageScaleFactory
 from plone.scale.scale import get_scale_mode
 from Products.CMFPlone.utils import safe_encode
-from ZODB.blob import BlobFile
 from ZODB.POSException import ConflictError
 from zope.interface import implementer
 
 import logging
 import PIL.Image
 import six
+import time
 
 
 try:
@@ -79,6 +90,11 @@ logger = logging.getLogger(__name__)
 
 @implementer(IImageScaleFactory)
 class ExperimentalImageScalingFactory(DefaultImageScalingFactory):
+    # The image value that we create the scale from.  See get_source_value.
+    source_value = None
+    # Set to False to create a standard scale, without focal point cropping.
+    use_focal_points = True
+
     def __init__(self, context):
         self.context = context
         if IPersistentTile is not None and IPersistentTile.providedBy(context):
@@ -149,19 +165,15 @@ class ExperimentalImageScalingFactory(DefaultImageScalingFactory):
         ):
             dummy, format_ = orig_value.contentType.split("/", 1)
             return orig_value, format_, (orig_value._width, orig_value._height)
-        orig_data = None
-        try:
-            orig_data = orig_value.open()
-        except AttributeError:
-            orig_data = getattr(aq_base(orig_value), "data", orig_value)
+        # CHANGED: Use a smaller version of the original when we have one.
+        source_value = self.get_source_value(orig_value, direction, height, width)
+        # CHANGED: Open committed blob files directly, and stream FileChunks
+        # instead of converting them to one string.
+        # Remember it for reusing a decoded image from this request.
+        self.source_value = source_value
+        orig_data = open_image_data(source_value)
         if not orig_data:
             return
-        # Handle cases where large image data is stored in FileChunks instead
-        # of plain string
-        if isinstance(orig_data, tuple(FILECHUNK_CLASSES)):
-            # Convert data to 8-bit string
-            # (FileChunk does not provide read() access)
-            orig_data = str(orig_data)
 
         # If quality wasn't in the parameters, try the site's default scaling
         # quality if it exists.
@@ -171,14 +183,24 @@ class ExperimentalImageScalingFactory(DefaultImageScalingFactory):
                 parameters["quality"] = quality
 
         if not getattr(orig_value, "contentType", "") == "image/svg+xml":
+            start = time.perf_counter()
             try:
-                result = self.create_scale(
-                    orig_data,
-                    direction=direction,
-                    height=height,
-                    width=width,
-                    **parameters,
-                )
+                # CHANGED: profile this when wanted.
+                with profile(
+                    "create_scale",
+                    self.context,
+                    size=(orig_value._width, orig_value._height),
+                ):
+                    # CHANGED: encode straight into the blob of the new value,
+                    # when there is a free slot.
+                    result = self.create_bounded_scale_value(
+                        orig_value,
+                        orig_data,
+                        direction=direction,
+                        height=height,
+                        width=width,
+                        **parameters,
+                    )
             except (ConflictError, KeyboardInterrupt):
                 raise
             except Exception:
@@ -192,16 +214,39 @@ class ExperimentalImageScalingFactory(DefaultImageScalingFactory):
                 return
             if result is None:
                 return
+            value, format_, dimensions = result
+            # CHANGED: tell the request recorder that we created a scale.
+            record_parameters = dict(
+                parameters, fieldname=fieldname, height=height, width=width
+            )
+            if "mode" not in parameters:
+                record_parameters["direction"] = direction
+            mark_created(
+                self.context, record_parameters, time.perf_counter() - start
+            )
         else:
             if isinstance(orig_data, (six.text_type)):
                 orig_data = safe_encode(orig_data)
             if isinstance(orig_data, (bytes)):
                 orig_data = BytesIO(orig_data)
 
-            result = orig_data.read(), "svg+xml", (width, height)
+            format_ = "svg+xml"
+            dimensions = (width, height)
+            value = self.new_value(orig_value, orig_data.read(), format_)
+        value.fieldname = fieldname
 
-        data, format_, dimensions = result
-        mimetype = "image/{0}".format(format_.lower())
+        # make sure the file is closed to avoid error:
+        # ZODB-5.5.1-py3.7.egg/ZODB/blob.py:339: ResourceWarning:
+        # unclosed file <_io.FileIO ... mode='rb' closefd=True>
+        if not isinstance(orig_data, (bytes, six.text_type)) and hasattr(
+            orig_data, "close"
+        ):
+            orig_data.close()
+
+        return value, format_, dimensions
+
+    def new_value(self, orig_value, data, format_):
+        """Create a new image value with the scale data."""
         # Note: we could create a patch so that every time we create a NamedBlobFile
         # or set data in it, we determine focal points.  But this code would also
         # be called here, where we create a scale, even though we have just used
@@ -212,21 +257,92 @@ class ExperimentalImageScalingFactory(DefaultImageScalingFactory):
         # Or do something funky like: set request.DONT_DO_IT, create the NamedBlobFile,
         # remove request.DONT_DO_IT, and let the code check this attribute.
         # Either way, seems a bit iffy.
-        value = orig_value.__class__(
+        return orig_value.__class__(
             data,
-            contentType=mimetype,
+            contentType="image/{0}".format(format_.lower()),
             filename=orig_value.filename,
         )
-        value.fieldname = fieldname
 
-        # make sure the file is closed to avoid error:
-        # ZODB-5.5.1-py3.7.egg/ZODB/blob.py:339: ResourceWarning:
-        # unclosed file <_io.FileIO ... mode='rb' closefd=True>
-        if isinstance(orig_data, BlobFile):
-            orig_data.close()
+    def create_bounded_scale_value(self, orig_value, data, **parameters):
+        """Create the scale value when there is a free slot for heavy work.
+
+        All Pillow work of scaling runs in this slot, see the limiter module.
+        When we are too busy, we create a standard scale without focal point
+        cropping or lazy detection.  This waits in line shorter, and is
+        created anyway after that: a page without its images is worse.
+        """
+        try:
+            with heavy_operation("image scaling"):
+                return self.create_scale_value(orig_value, data, **parameters)
+        except Saturated:
+            pass
+        logger.warning(
+            "Too busy to crop field %r of %s. Creating a standard scale.",
+            self.fieldname,
+            self.url(),
+        )
+        self.use_focal_points = False
+        try:
+            with heavy_operation("standard scaling", timeout=config.FALLBACK_TIMEOUT):
+                return self.create_scale_value(orig_value, data, **parameters)
+        except Saturated:
+            pass
+        return self.create_scale_value(orig_value, data, **parameters)
+
+    def create_scale_value(
+        self, orig_value, data, direction, height, width, **parameters
+    ):
+        """Create the scale and return the new value, format and dimensions.
 
+        For blob images we pass the blob file of the new value to create_scale
+        as 'result', so the scale is encoded straight into it, instead of
+        into bytes that the new value copies into its blob.
+        Returns None when there is no scale.
+        """
+        value = orig_value.__class__(filename=orig_value.filename)
+        blob = getattr(value, "_blob", None)
+        if blob is None:
+            result = self.create_scale(data, direction, height, width, **parameters)
+            if result is None:
+                return
+            data, format_, dimensions = result
+            return self.new_value(orig_value, data, format_), format_, dimensions
+        with blob.open("w") as blob_file:
+            result = self.create_scale(
+                data, direction, height, width, result=blob_file, **parameters
+            )
+            if result is None:
+                return
+            data, format_, dimensions = result
+            if isinstance(data, bytes):
+                # A scale that was created before, for example in a srcset batch.
+                blob_file.write(data)
+        # We have written the data ourselves, so set what _setData would set.
+        value.contentType = "image/{0}".format(format_.lower())
+        value._width, value._height = dimensions
         return value, format_, dimensions
 
+    def get_source_value(self, orig_value, direction, height, width):
+        """Get the image value that we create the scale from.
+
+        This is the smallest level from the pyramid of the original
+        that is still large enough, or the original itself.
+        """
+        batch = get_srcset_batch(self, width, height)
+        if batch is not None:
+            # All widths of the srcset are created from the same source,
+            # so it must be large enough for the largest one.
+            width, height = batch.sizes[0]
+        mode = get_scale_mode("contain", direction)
+        level = get_pyramid_level(orig_value, width=width, height=height, mode=mode)
+        if level is None:
+            return orig_value
+        logger.debug(
+            f"Scaling from pyramid level {level._width}x{level._height} "
+            f"of {self.url()}"
+        )
+        return level
+
     def create_scale(self, data, direction, height, width, **parameters):
         """Scale the given image data to another size and return the result
         as a string or optionally write in to the file-like `result` object.
@@ -255,7 +371,7 @@ class ExperimentalImageScalingFactory(DefaultImageScalingFactory):
         logger.debug(
             f"create_scale({self.content_context.portal_type} at {self.url()}, mode={mode}, height={height}, width={width}, {parameters})"
         )
-        if mode != "contain":
+        if mode != "contain" or not self.use_focal_points:
             # We don't want cropping, just a boring scale. Plone can handle this itself.
             # Note: mode 'cover' says it scales up (when needed) and then crops,
             # but in my testing the cropping is never needed.  So standard Plone
@@ -268,27 +384,104 @@ class ExperimentalImageScalingFactory(DefaultImageScalingFactory):
         # Future: use getAdapters to get named adapters and call them all.
         transformer = CropFocalPointsTransformer(self.context)
         transformer.prepare(field, mode)
+        pil_image = None
+        if not transformer.available and needs_lazy_detection(field):
+            # CHANGED: detect on the original that we decode for this crop anyway.
+            pil_image = self.detect_lazily(field, data)
+            transformer.prepare(field, mode)
         if not transformer.available:
             # No focal points were set.
             return super().create_scale(data, direction, height, width, **parameters)
 
-        # Open the image with PIL.
+        # The factory already has a slot.  This is for other callers.
+        with heavy_operation("focal point scaling"):
+            return self.create_focal_scale(
+                transformer,
+                data,
+                direction,
+                height,
+                width,
+                pil_image=pil_image,
+                **parameters,
+            )
+
+    def detect_lazily(self, field, data):
+        """Determine the focal point of a field on which detection never ran.
+
+        Returns the decoded source image, or None.
+        """
+        if self.source_value is not field:
+            # A pyramid level: this was made by a detection after all.
+            return
+        pil_image = self.open_source_image(data)
+        if pil_image is None:
+            return
+        logger.info("Determining focal point on first crop of %s", self.url())
+        determine_focalpoint_lazily(field, pil_image, context=self.context)
+        return pil_image
+
+    def create_focal_scale(
+        self, transformer, data, direction, height, width, pil_image=None, **parameters
+    ):
+        """Create scale with the prepared focal points transformer.
+
+        pil_image is the source image, when it has been opened already.
+        """
+        batch = get_srcset_batch(self, width, height)
+        if batch is not None:
+            # A srcset helper has asked for a series of widths.
+            # Create all of them from this one decode.
+            return batch.get_scale(self, data, width, height, **parameters)
+
+        if pil_image is None:
+            pil_image = self.open_source_image(data)
+        if pil_image is None:
+            # Try upstream for good measure.
+            return super().create_scale(data, direction, height, width, **parameters)
+        format_, icc_profile = self.get_save_format(pil_image)
+
+        # Note: some transformers may change the image in place,
+        # others could return a new one.
+        source_image = pil_image
+        new_image = transformer.run(pil_image, target_width=width, target_height=height)
+        if new_image:
+            pil_image = new_image
+
+        result = self.save_image(pil_image, format_, icc_profile, **parameters)
+        # Cropping has decoded the source.  Other scales in this request can use it.
+        remember_decoded_image(self.source_value, source_image)
+        return result
+
+    def open_source_image(self, data):
+        """Get the source image decoded earlier in this request, or open the data."""
+        if self.source_value is not None:
+            pil_image = get_decoded_image(self.source_value)
+            if pil_image is not None:
+                return pil_image
+        return self.open_image(data)
+
+    def open_image(self, data):
+        """Open the image data with PIL.
+
+        Returns None when the data cannot be opened as image.
+        """
         if isinstance(data, bytes):
             data = BytesIO(data)
         try:
-            pil_image = PIL.Image.open(data)
+            return PIL.Image.open(data)
         except OSError:
             # Probably: cannot identify image file
             # Locally I have experimental.gracefulblobmissing,
             # so image blobs may be wrong.
             logger.warning("OSError opening image file at %s", self.url())
-            # Try upstream for good measure.
-            return super().create_scale(data, direction, height, width, **parameters)
 
-        # Note that the original create_scale calls scaleImage,
-        # which does various things, to improve the end result.
-        # I take over some of it.
+    def get_save_format(self, pil_image):
+        """Get the format and icc profile to use when saving a scale.
 
+        Note that the original create_scale calls scaleImage,
+        which does various things, to improve the end result.
+        I take over some of it.
+        """
         # When we create a new image during scaling we loose the format
         # information, so remember it here.  We will use it when saving.
         # Scale format will be JPEG or PNG.
@@ -300,34 +493,24 @@ class ExperimentalImageScalingFactory(DefaultImageScalingFactory):
             # GIF scaled looks better if we have 8-bit alpha and no palette
             format_ = "PNG"
         icc_profile = pil_image.info.get("icc_profile")
+        return format_, icc_profile
 
-        # Note: some transformers may change the image in place,
-        # others could return a new one.
-        new_image = transformer.run(pil_image, target_width=width, target_height=height)
-        if new_image:
-            pil_image = new_image
-
+    def save_image(self, pil_image, format_, icc_profile, **parameters):
+        """Save the PIL image and return the create_scale result."""
         # We need to handle two parameters that are used when saving the image to disk:
         # quality and result.
         quality = parameters.get("quality", 88)
         result = parameters.get("result", None)
-
-        new_result = False
-        if result is None:
-            result = BytesIO()
-            new_result = True
-        # Save the PIL image to the result, using the format determined above.
-        pil_image.save(
-            result,
-            format_,
-            quality=quality,
-            optimize=True,
-            progressive=True,
-            icc_profile=icc_profile,
+        if pil_image.mode == "RGBX":
+            # From a shared RGB original.  PNG cannot save this.
+            pil_image = pil_image.convert("RGB")
+
+        # CHANGED: Save the PIL image to the result, using the format determined
+        # above, with the encoder profile for the size of the scale.
+        result = encode(
+            pil_image, format_, quality, icc_profile=icc_profile, result=result
         )
-        if new_result:
-            result = result.getvalue()
-        else:
+        if not isinstance(result, bytes):
             result.seek(0)
 
         return result, format_, pil_image.size
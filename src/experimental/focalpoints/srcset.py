@@ -0,0 +1,219 @@
+"""Create a srcset of focal point crops in one go.
+
+For responsive images a template wants the same crop in several widths.
+Calling images_view.tag once per width means that every width opens the
+original and does its own crop and resize.
+
+With the srcset view below, we register a batch of sizes on the request,
+and then ask the standard @@images view for each scale, largest first.
+Scales that are already stored are simply returned by the scale storage.
+The first scale that needs to be created ends up in our scaling factory,
+which sees the batch and creates all widths at once:
+
+- open the original once,
+- determine one crop box around the focal point for the aspect ratio,
+- resize to the largest width,
+- resize each next width from the previous, smaller, result.
+
+So the whole set costs roughly one resize of the original.
+"""
+from .focalpoint.orientation import get_displayed_size
+from .focalpoint.orientation import get_orientation
+from .focalpoint.orientation import swap_size
+from .focalpoint.orientation import transpose_image
+from .focalpoint.transformer import CropFocalPointsTransformer
+from html import escape
+from Products.Five import BrowserView
+from zope.annotation.interfaces import IAnnotations
+from zope.component import getMultiAdapter
+from zope.globalrequest import getRequest
+
+import logging
+import math
+import PIL.Image
+
+
+logger = logging.getLogger(__name__)
+ANNOTATION_KEY = "experimental.focalpoints.srcset"
+DEFAULT_WIDTHS = (1600, 1200, 800, 400, 200)
+
+
+def get_srcset_batch(factory, width, height):
+    """Get the srcset batch that contains this scale, if any."""
+    request = getRequest()
+    if request is None or not width or not height:
+        return
+    batches = IAnnotations(request).get(ANNOTATION_KEY)
+    if not batches:
+        return
+    batch = batches.get((factory.url(), factory.fieldname))
+    if batch is None or (int(width), int(height)) not in batch.sizes:
+        return
+    return batch
+
+
+class SrcsetBatch:
+    """Batch of scales with the same aspect ratio for one image field."""
+
+    def __init__(self, sizes):
+        # List of (width, height) tuples, largest first.
+        self.sizes = sorted(sizes, reverse=True)
+        self.results = None
+
+    def get_scale(self, factory, data, width, height, **parameters):
+        """Get the create_scale result for this width and height.
+
+        The first call creates the scales for all sizes.
+        """
+        if self.results is None:
+            # The result parameter is for one scale only.
+            parameters.pop("result", None)
+            self.results = self.create_scales(factory, data, **parameters)
+        return self.results.get((int(width), int(height)))
+
+    def create_scales(self, factory, data, **parameters):
+        pil_image = factory.open_source_image(data)
+        if pil_image is None:
+            return {}
+        format_, icc_profile = factory.get_save_format(pil_image)
+        transformer = CropFocalPointsTransformer(factory.context)
+        transformer.prepare(factory.get_original_value(), "contain")
+        source_width, source_height = source_size = pil_image.size
+        # We work on raw pixels and only transpose the results.
+        orientation = get_orientation(pil_image)
+        target_width, target_height = self.sizes[0]
+        box = None
+        if transformer.available:
+            box = transformer.get_crop_box(
+                source_size, target_width, target_height, orientation
+            )
+        if box is None:
+            box = (0, 0, source_width, source_height)
+        target_width, target_height = swap_size(self.sizes[0], orientation)
+
+        # Let JPEG decode at a reduced size when even the largest width
+        # is much smaller than the crop box.  This does nothing for other formats.
+        factor = target_width / (box[2] - box[0])
+        if factor < 1:
+            pil_image.draft(
+                pil_image.mode,
+                (math.ceil(source_width * factor), math.ceil(source_height * factor)),
+            )
+            factor_x = pil_image.size[0] / source_width
+            factor_y = pil_image.size[1] / source_height
+            box = (
+                int(box[0] * factor_x),
+                int(box[1] * factor_y),
+                int(math.ceil(box[2] * factor_x)),
+                int(math.ceil(box[3] * factor_y)),
+            )
+        logger.debug(f"Cropping image for srcset {self.sizes}: {box}")
+        pil_image = pil_image.crop(box)
+
+        results = {}
+        for size in self.sizes:
+            # Each size is created from the previous, larger, one.
+            pil_image = pil_image.resize(
+                swap_size(size, orientation), PIL.Image.ANTIALIAS
+            )
+            results[size] = factory.save_image(
+                transpose_image(pil_image, orientation),
+                format_,
+                icc_profile,
+                **parameters,
+            )
+        return results
+
+
+class FocalPointSrcset(BrowserView):
+    """Create img tags with a srcset of focal point crops.
+
+    Use it in a template like this:
+
+        image/@@focalpoint-srcset/tag('image', aspect_ratio='16:9')
+    """
+
+    def get_aspect_ratio(self, aspect_ratio, image_field):
+        """Get aspect ratio (width / height) as float.
+
+        This can be a number, or a string like '16:9'.
+        By default we use the ratio of the original image.
+        """
+        if not aspect_ratio:
+            width, height = get_displayed_size(image_field)
+            return width / height
+        if isinstance(aspect_ratio, str) and ":" in aspect_ratio:
+            width, height = aspect_ratio.split(":", 1)
+            return float(width) / float(height)
+        return float(aspect_ratio)
+
+    def get_sizes(self, image_field, widths, aspect_ratio):
+        """Get list of (width, height) tuples, largest first.
+
+        We never scale up: widths larger than the original are left out.
+        """
+        original_width = get_displayed_size(image_field)[0]
+        ratio = self.get_aspect_ratio(aspect_ratio, image_field)
+        sizes = []
+        for width in sorted(set(int(width) for width in widths), reverse=True):
+            if width > original_width and width != min(widths):
+                continue
+            sizes.append((width, max(int(round(width / ratio)), 1)))
+        return sizes
+
+    def get_scales(self, fieldname="image", widths=DEFAULT_WIDTHS, aspect_ratio=None):
+        """Get the image scales, largest first."""
+        image_field = getattr(self.context, fieldname, None)
+        if not image_field:
+            return []
+        sizes = self.get_sizes(image_field, widths, aspect_ratio)
+        images_view = getMultiAdapter((self.context, self.request), name="images")
+        batches = IAnnotations(self.request).setdefault(ANNOTATION_KEY, {})
+        key = (self.context.absolute_url(), fieldname)
+        batches[key] = SrcsetBatch(sizes)
+        try:
+            scales = [
+                images_view.scale(
+                    fieldname, width=width, height=height, direction="contain"
+                )
+                for width, height in sizes
+            ]
+        finally:
+            del batches[key]
+        return [scale for scale in scales if scale is not None]
+
+    def srcset(self, fieldname="image", widths=DEFAULT_WIDTHS, aspect_ratio=None):
+        scales = self.get_scales(fieldname, widths, aspect_ratio)
+        return self.format_srcset(scales)
+
+    def format_srcset(self, scales):
+        return ", ".join(f"{scale.url} {scale.width}w" for scale in scales)
+
+    def tag(
+        self,
+        fieldname="image",
+        widths=DEFAULT_WIDTHS,
+        aspect_ratio=None,
+        sizes="100vw",
+        alt=None,
+        css_class=None,
+    ):
+        scales = self.get_scales(fieldname, widths, aspect_ratio)
+        if not scales:
+            return ""
+        # The largest scale is the fallback for browsers without srcset.
+        largest = scales[0]
+        if alt is None:
+            alt = self.context.Title()
+        srcset = self.format_srcset(scales)
+        parts = [
+            f'src="{escape(largest.url)}"',
+            f'srcset="{escape(srcset)}"',
+            f'sizes="{escape(sizes)}"',
+            f'width="{largest.width}"',
+            f'height="{largest.height}"',
+            f'alt="{escape(alt)}"',
+        ]
+        if css_class:
+            parts.append(f'class="{escape(css_class)}"')
+        return "<img {} />".format(" ".join(parts))
@@ -0,0 +1,93 @@
+"""Startup cost of the heavy libraries.
+
+OpenCV and NumPy are only imported when the first detection runs.
+With FOCALPOINTS_WARMUP on, we import them in a background thread
+when Zope has started, so the first editor does not have to wait.
+
+To see what this saves, run the measure script.  It starts a fresh Python
+process for each step and reports the import time and peak memory (RSS):
+
+    bin/focalpoints-importtime
+"""
+from . import config
+from zope.component import adapter
+from zope.processlifetime import IProcessStarting
+
+import logging
+import subprocess
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+# Modules that Zope imports at startup because of our zcml.
+STARTUP_MODULES = (
+    "experimental.focalpoints.focalpoint.datamanager",
+    "experimental.focalpoints.scaling",
+)
+
+
+def warm_up():
+    """Import OpenCV and NumPy and run a tiny detection."""
+    from .focalpoint.detectors import get_detector_class
+
+    import PIL.Image
+
+    start = time.time()
+    try:
+        get_detector_class()(None).detect(PIL.Image.new("L", (16, 16)))
+    except Exception:
+        logger.exception("Error warming up focal point detection.")
+        return
+    logger.info("Warmed up focal point detection in %.2f seconds.", time.time() - start)
+
+
+@adapter(IProcessStarting)
+def process_starting(event):
+    if not config.WARMUP:
+        return
+    thread = threading.Thread(target=warm_up, name="focalpoints-warmup")
+    thread.daemon = True
+    thread.start()
+
+
+MEASURE_CODE = """
+import resource, sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+if {warm_up!r}:
+    from experimental.focalpoints.startup import warm_up
+    warm_up()
+duration = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform != "darwin":
+    # Linux reports kilobytes, macOS bytes.
+    rss *= 1024
+print(duration, rss)
+"""
+
+
+def measure(modules, warm_up=False):
+    """Measure import time and peak RSS in a fresh process."""
+    code = MEASURE_CODE.format(modules=tuple(modules), warm_up=warm_up)
+    output = subprocess.check_output([sys.executable, "-c", code])
+    duration, rss = output.split()
+    return float(duration), int(rss)
+
+
+def main(argv=None):
+    steps = (
+        ("python", (), False),
+        ("startup imports", STARTUP_MODULES, False),
+        ("after first detection", STARTUP_MODULES, True),
+    )
+    print(f"{'step':<24} {'seconds':>8} {'RSS MB':>8}")
+    for name, modules, warm in steps:
+        duration, rss = measure(modules, warm_up=warm)
+        print(f"{name:<24} {duration:>8.3f} {rss / 1024 / 1024:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Synthetic test images.
+
+These are used by the load test and benchmark tools.
+They look a bit like photos: a smooth, slightly noisy background,
+with a few subjects that have edges and corners.
+We know where the subjects are, so we know where the focal point should be.
+"""
+from dataclasses import dataclass
+from io import BytesIO
+
+import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+
+
+@dataclass
+class Subject:
+    """Box (left, top, right, bottom) of a subject in a synthetic image."""
+
+    left: int
+    top: int
+    right: int
+    bottom: int
+
+    @property
+    def center(self):
+        return (self.left + self.right) / 2, (self.top + self.bottom) / 2
+
+    @property
+    def area(self):
+        return (self.right - self.left) * (self.bottom - self.top)
+
+
+def make_image(width, height, seed=0, subjects=1, subject_size=0.2):
+    """Create a synthetic photo-like image.
+
+    Returns the PIL image and a list of Subject boxes.
+    subject_size is the size of a subject relative to the smallest side.
+    """
+    random = np.random.default_rng(seed)
+    # Smooth background: a gradient in a random direction plus a little noise.
+    # Keep memory low: this is also used for images of 50 megapixels.
+    angle = random.uniform(0, 2 * np.pi)
+    x_range = np.arange(width, dtype=np.float32)[np.newaxis, :] / width
+    y_range = np.arange(height, dtype=np.float32)[:, np.newaxis] / height
+    gradient = np.float32(40 * np.cos(angle)) * x_range + np.float32(
+        40 * np.sin(angle)
+    ) * y_range
+    gradient += random.integers(-4, 5, size=(height, width), dtype=np.int8)
+    base = random.uniform(60, 160, size=3)
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    for channel in range(3):
+        pixels[:, :, channel] = np.clip(gradient + base[channel], 0, 255)
+    del gradient
+    image = PIL.Image.fromarray(pixels, "RGB")
+    del pixels
+
+    # Subjects: a textured rectangle with some shapes on it.
+    draw = PIL.ImageDraw.Draw(image)
+    size = max(int(min(width, height) * subject_size), 8)
+    boxes = []
+    for _subject in range(subjects):
+        left = int(random.integers(0, max(width - size, 1)))
+        top = int(random.integers(0, max(height - size, 1)))
+        subject = Subject(left, top, left + size, top + size)
+        boxes.append(subject)
+        color = tuple(int(c) for c in random.integers(0, 255, size=3))
+        draw.rectangle((left, top, left + size, top + size), fill=color)
+        for _shape in range(12):
+            x1 = left + int(random.integers(0, size))
+            y1 = top + int(random.integers(0, size))
+            x2 = min(x1 + int(random.integers(2, size // 3 + 3)), left + size)
+            y2 = min(y1 + int(random.integers(2, size // 3 + 3)), top + size)
+            fill = tuple(int(c) for c in random.integers(0, 255, size=3))
+            if random.random() < 0.5:
+                draw.rectangle((x1, y1, x2, y2), fill=fill)
+            else:
+                draw.ellipse((x1, y1, x2, y2), fill=fill)
+    return image, boxes
+
+
+def make_image_data(width, height, seed=0, format_="JPEG", **kwargs):
+    """Create a synthetic image and return the encoded data and subjects."""
+    image, subjects = make_image(width, height, seed=seed, **kwargs)
+    result = BytesIO()
+    if format_ == "JPEG":
+        image.save(result, format_, quality=90)
+    else:
+        image.save(result, format_)
+    return result.getvalue(), subjects
@@ -0,0 +1,46 @@
+from plone.app.contenttypes.testing import PLONE_APP_CONTENTTYPES_FIXTURE
+from plone.app.testing import applyProfile
+from plone.app.testing import FunctionalTesting
+from plone.app.testing import IntegrationTesting
+from plone.app.testing import PloneSandboxLayer
+from zope.configuration import xmlconfig
+
+import experimental.focalpoints
+
+
+class ExperimentalFocalpointsLayer(PloneSandboxLayer):
+
+    defaultBases = (PLONE_APP_CONTENTTYPES_FIXTURE,)
+
+    def setUpZope(self, app, configurationContext):
+        try:
+            import plone.tiles
+        except ImportError:
+            pass
+        else:
+            self.loadZCML(package=plone.tiles)
+        self.loadZCML(package=experimental.focalpoints)
+        # Our scaling factory overrides the one from plone.namedfile.
+        xmlconfig.includeOverrides(
+            configurationContext,
+            "overrides.zcml",
+            package=experimental.focalpoints,
+        )
+
+    def setUpPloneSite(self, portal):
+        applyProfile(portal, "experimental.focalpoints:default")
+
+
+EXPERIMENTAL_FOCALPOINTS_FIXTURE = ExperimentalFocalpointsLayer()
+
+
+EXPERIMENTAL_FOCALPOINTS_INTEGRATION_TESTING = IntegrationTesting(
+    bases=(EXPERIMENTAL_FOCALPOINTS_FIXTURE,),
+    name="ExperimentalFocalpointsLayer:IntegrationTesting",
+)
+
+
+EXPERIMENTAL_FOCALPOINTS_FUNCTIONAL_TESTING = FunctionalTesting(
+    bases=(EXPERIMENTAL_FOCALPOINTS_FIXTURE,),
+    name="ExperimentalFocalpointsLayer:FunctionalTesting",
+)
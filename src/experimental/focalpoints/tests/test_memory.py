@@ -0,0 +1,77 @@
+"""Peak memory budgets per stage, see the memory module."""
+from experimental.focalpoints import memory
+from experimental.focalpoints.testing import (
+    EXPERIMENTAL_FOCALPOINTS_INTEGRATION_TESTING,
+)
+
+import shutil
+import tempfile
+import unittest
+
+
+class MemoryBudgetsMixin:
+    """Each stage runs in a fresh process on a large synthetic original.
+
+    Subclasses set the size of the original, see memory.DEFAULT_MEGAPIXELS.
+    """
+
+    layer = EXPERIMENTAL_FOCALPOINTS_INTEGRATION_TESTING
+    megapixels = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.paths = {
+            format_: memory.write_original(cls.directory, cls.megapixels, format_)
+            for format_ in memory.DEFAULT_FORMATS
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def assertWithinBudget(self, stage, format_):
+        result = memory.measure(stage, self.paths[format_])
+        over = memory.check(stage, result)
+        self.assertEqual(
+            over,
+            [],
+            "Over budget: "
+            + memory.format_line(self.megapixels, format_, stage, result, over),
+        )
+
+    def test_decode_jpeg(self):
+        self.assertWithinBudget("decode", "JPEG")
+
+    def test_decode_png(self):
+        self.assertWithinBudget("decode", "PNG")
+
+    def test_detect_jpeg(self):
+        self.assertWithinBudget("detect", "JPEG")
+
+    def test_detect_png(self):
+        self.assertWithinBudget("detect", "PNG")
+
+    def test_crop_jpeg(self):
+        self.assertWithinBudget("crop", "JPEG")
+
+    def test_crop_png(self):
+        self.assertWithinBudget("crop", "PNG")
+
+    def test_create_scale_jpeg(self):
+        self.assertWithinBudget("create_scale", "JPEG")
+
+    def test_create_scale_png(self):
+        self.assertWithinBudget("create_scale", "PNG")
+
+
+class TestMemoryBudgets12(MemoryBudgetsMixin, unittest.TestCase):
+    megapixels = 12
+
+
+class TestMemoryBudgets24(MemoryBudgetsMixin, unittest.TestCase):
+    megapixels = 24
+
+
+class TestMemoryBudgets50(MemoryBudgetsMixin, unittest.TestCase):
+    megapixels = 50
@@ -0,0 +1,60 @@
+"""Pyramid levels of originals with an EXIF orientation."""
+from experimental.focalpoints.focalpoint.orientation import get_orientation
+from experimental.focalpoints.focalpoint.orientation import ORIENTATION_TAG
+from experimental.focalpoints.focalpoint.pyramid import get_pyramid_level
+from experimental.focalpoints.focalpoint.pyramid import make_levels
+from experimental.focalpoints.testing import (
+    EXPERIMENTAL_FOCALPOINTS_INTEGRATION_TESTING,
+)
+from io import BytesIO
+from plone.namedfile.file import NamedBlobImage
+
+import PIL.Image
+import unittest
+
+
+def make_rotated_jpeg(width, height, orientation):
+    """Make a JPEG with raw pixels of this size and an EXIF orientation."""
+    exif = PIL.Image.Exif()
+    exif[ORIENTATION_TAG] = orientation
+    result = BytesIO()
+    PIL.Image.new("RGB", (width, height), "red").save(
+        result, "JPEG", exif=exif.tobytes()
+    )
+    return result.getvalue()
+
+
+class TestPyramidOrientation(unittest.TestCase):
+
+    layer = EXPERIMENTAL_FOCALPOINTS_INTEGRATION_TESTING
+
+    def setUp(self):
+        # Raw pixels 2048x1024, displayed 1024x2048.
+        data = make_rotated_jpeg(2048, 1024, 6)
+        # Like an original that has kept its raw pixels.
+        self.field = NamedBlobImage(filename="rotated.jpg")
+        self.field.data = data
+        self.field.orientation = 6
+        self.levels = make_levels(self.field, PIL.Image.open(BytesIO(data)))
+        self.field.pyramid = self.levels
+
+    def test_levels_keep_raw_pixels(self):
+        self.assertEqual(
+            [(level._width, level._height) for level in self.levels],
+            [(1024, 512), (512, 256)],
+        )
+        for level in self.levels:
+            with level.open() as blob_file:
+                self.assertEqual(get_orientation(PIL.Image.open(blob_file)), 6)
+
+    def test_get_pyramid_level(self):
+        # Displayed sizes of the levels are 512x1024 and 256x512.
+        level = get_pyramid_level(self.field, width=256, height=512, mode="scale")
+        self.assertIs(level, self.levels[1])
+        level = get_pyramid_level(self.field, width=300, height=300, mode="scale")
+        self.assertIs(level, self.levels[1])
+        # Covering 300x300 needs 300x600.
+        level = get_pyramid_level(self.field, width=300, height=300)
+        self.assertIs(level, self.levels[0])
+        level = get_pyramid_level(self.field, width=1000, height=2000, mode="scale")
+        self.assertIsNone(level)
@@ -0,0 +1,67 @@
+"""Decoded images shared between processes, see the shared module."""
+from experimental.focalpoints.focalpoint import shared
+
+import multiprocessing
+import os
+import PIL.Image
+import shutil
+import tempfile
+import unittest
+
+
+def use_image(directory, max_bytes, digest, ready, stop):
+    """Use a shared image in another process until we are told to stop."""
+    cache = shared.SharedImageCache(directory, max_bytes)
+    pil_image = cache.get(digest)
+    ready.set()
+    stop.wait(30)
+    del pil_image
+
+
+@unittest.skipIf(
+    shared.fcntl is None or not shared.HAS_SHARED_MEMORY,
+    "Shared memory is not supported here.",
+)
+class TestSharedImageCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Room for two images of 100x100 pixels, but not for three.
+        self.max_bytes = 25000
+        self.cache = shared.SharedImageCache(self.directory, self.max_bytes)
+
+    def tearDown(self):
+        self.cache.clear()
+        shutil.rmtree(self.directory)
+
+    def make_digest(self):
+        return os.urandom(32).hex()
+
+    def test_put_without_room_keeps_index(self):
+        used = self.make_digest()
+        unused = self.make_digest()
+        self.assertTrue(self.cache.put(used, PIL.Image.new("L", (100, 100))))
+        self.assertTrue(self.cache.put(unused, PIL.Image.new("L", (100, 100))))
+        ready = multiprocessing.Event()
+        stop = multiprocessing.Event()
+        process = multiprocessing.Process(
+            target=use_image,
+            args=(self.directory, self.max_bytes, used, ready, stop),
+        )
+        process.start()
+        try:
+            self.assertTrue(ready.wait(30))
+            # Removing the unused image is not enough to fit this one.
+            big = self.make_digest()
+            self.assertFalse(self.cache.put(big, PIL.Image.new("L", (100, 150))))
+            # So the unused image is still there, in the index and in memory.
+            self.assertEqual(self.cache.stats()["entries"], 2)
+            pil_image = self.cache.get(unused)
+            self.assertIsNotNone(pil_image)
+            self.assertEqual(pil_image.size, (100, 100))
+            del pil_image
+        finally:
+            stop.set()
+            process.join(30)
+        # Nobody uses the first image now, so this fits.
+        self.assertTrue(self.cache.put(big, PIL.Image.new("L", (100, 150))))
+        self.assertEqual(self.cache.stats()["entries"], 1)
@@ -1,3 +1,5 @@
+from .recording import RecordingMixin
+from .revalidate import StaleWhileRevalidateMixin
 from plone.app.tiles.imagescaling import AnnotationStorage
 from plone.app.tiles.imagescaling import ImageScale
 from plone.app.tiles.imagescaling import ImageScaling
@@ -6,6 +8,12 @@ from plone.rfc822.interfaces import IPrimaryFieldInfo
 from zope.interface import alsoProvides
 
 
+class TileAnnotationStorage(
+    RecordingMixin, StaleWhileRevalidateMixin, AnnotationStorage
+):
+    """Annotation storage for scales of tiles."""
+
+
 class TileImageScaling(ImageScaling):
     def scale(self, fieldname=None, scale=None, height=None, width=None, **parameters):
         if fieldname is None:
@@ -18,7 +26,8 @@ class TileImageScaling(ImageScaling):
             if scale not in available:
                 return None
             width, height = available[scale]
-        storage = AnnotationStorage(self.context, self.modified)
+        # CHANGED: use a storage that can serve stale crop scales for a while.
+        storage = TileAnnotationStorage(self.context, self.modified)
         # CHANGED: We do not pass a factory here, which is long deprecated anyway,
         # but rely on storage.scale to find the right IImageScaleFactory adapter.
         # info = storage.scale(
@@ -0,0 +1,280 @@
+"""Export and import focal points as JSON Lines.
+
+When content is copied to another site, every image would go through
+detection again.  Instead, export the focal points from the old site,
+and import them in the new one.  Each line is one image field:
+
+    {"uid": "...", "tile": null, "field": "image", "digest": "sha256 hex",
+     "size": [3000, 2000], "focal_point": [1200, 800],
+     "focal_points": [[1100, 750, 1.0]], "focal_point_date": 1700000000.0,
+     "orientation": null}
+
+'tile' is the tile id for an image in a persistent tile, otherwise null.
+On import we find the item by UID and compare the digest of the image data.
+When it matches, we set the focal point attributes directly,
+without decoding the image.
+
+Managers can use two views on the site root:
+
+- @@focalpoints-export streams the JSON Lines,
+- @@focalpoints-import reads them from the 'file' upload in a POST request.
+
+Or use the script with the configuration of a Zope instance:
+
+    bin/focalpoints-transfer --zope-conf parts/instance/etc/zope.conf \\
+        --site Plone export focalpoints.jsonl
+"""
+from .compaction import TILE_DATA_PREFIX
+from .focalpoint.blobs import get_digest
+from .focalpoint.subscriber import get_image_fields
+from plone.namedfile.interfaces import INamedImage
+from plone.protect.interfaces import IDisableCSRFProtection
+from Products.CMFCore.utils import getToolByName
+from Products.Five import BrowserView
+from zope.annotation.interfaces import IAnnotations
+from zope.interface import alsoProvides
+
+import argparse
+import json
+import logging
+import sys
+import transaction
+
+
+logger = logging.getLogger(__name__)
+# Attributes that we export and import.
+ATTRIBUTES = ("focal_point", "focal_points", "focal_point_date", "orientation")
+# Commit after importing this many images.
+COMMIT_EVERY = 500
+
+
+def get_tile_image_fields(obj):
+    """Get (tile id, fieldname, value) for images in persistent tiles."""
+    annotations = IAnnotations(obj, None)
+    if annotations is None:
+        return []
+    fields = []
+    for key in list(annotations.keys()):
+        if not isinstance(key, str) or not key.startswith(TILE_DATA_PREFIX):
+            continue
+        data = annotations[key]
+        if not hasattr(data, "items"):
+            continue
+        tile_id = key[len(TILE_DATA_PREFIX) :]
+        for name, value in data.items():
+            if INamedImage.providedBy(value):
+                fields.append((tile_id, name, value))
+    return fields
+
+
+def get_all_image_fields(obj):
+    """Get (tile id, fieldname, value) for the item and its tiles.
+
+    The tile id is None for the fields of the item itself.
+    """
+    fields = [(None, name, value) for name, value in get_image_fields(obj)]
+    fields.extend(get_tile_image_fields(obj))
+    return fields
+
+
+def make_record(uid, tile_id, name, value):
+    focal_point = getattr(value, "focal_point", None)
+    focal_points = getattr(value, "focal_points", None)
+    return {
+        "uid": uid,
+        "tile": tile_id,
+        "field": name,
+        "digest": get_digest(value),
+        "size": [getattr(value, "_width", 0), getattr(value, "_height", 0)],
+        "focal_point": list(focal_point) if focal_point else None,
+        "focal_points": [list(point) for point in focal_points]
+        if focal_points
+        else None,
+        "focal_point_date": getattr(value, "focal_point_date", None),
+        "orientation": getattr(value, "orientation", None),
+    }
+
+
+def iter_objects(site):
+    catalog = getToolByName(site, "portal_catalog")
+    for brain in catalog.unrestrictedSearchResults():
+        try:
+            obj = brain._unrestrictedGetObject()
+        except (AttributeError, KeyError):
+            logger.warning("Could not get object at %s", brain.getPath())
+            continue
+        yield brain.UID, obj
+
+
+def export_focal_points(site):
+    """Yield JSON lines with the focal points of all image fields.
+
+    Fields on which detection never ran are skipped.
+    """
+    for uid, obj in iter_objects(site):
+        if not uid:
+            continue
+        for tile_id, name, value in get_all_image_fields(obj):
+            if getattr(value, "focal_point_date", None) is None:
+                continue
+            record = make_record(uid, tile_id, name, value)
+            yield json.dumps(record, sort_keys=True) + "\n"
+
+
+def find_field_value(site, record):
+    """Find the image field value of the record.  Returns (obj, value)."""
+    catalog = getToolByName(site, "portal_catalog")
+    brains = catalog.unrestrictedSearchResults(UID=record["uid"])
+    if not brains:
+        return None, None
+    obj = brains[0]._unrestrictedGetObject()
+    tile_id = record.get("tile")
+    if tile_id is None:
+        return obj, getattr(obj, record["field"], None)
+    data = IAnnotations(obj).get(TILE_DATA_PREFIX + tile_id)
+    if data is None:
+        return obj, None
+    return obj, data.get(record["field"])
+
+
+def import_record(site, record):
+    """Set the focal points of one record.
+
+    Returns the outcome ('imported', 'missing' or 'changed') and the item.
+    """
+    obj, value = find_field_value(site, record)
+    if value is None:
+        return "missing", obj
+    if get_digest(value) != record["digest"]:
+        return "changed", obj
+    for name in ATTRIBUTES:
+        item = record.get(name)
+        if name == "focal_point" and item:
+            item = tuple(item)
+        elif name == "focal_points" and item:
+            item = [tuple(point) for point in item]
+        setattr(value, name, item)
+    return "imported", obj
+
+
+def import_focal_points(site, lines, commit_every=COMMIT_EVERY):
+    """Import focal points from JSON lines.  Returns counts per outcome."""
+    counts = {"imported": 0, "missing": 0, "changed": 0, "invalid": 0}
+    pending = 0
+    to_reindex = {}
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            counts["invalid"] += 1
+            continue
+        outcome, obj = import_record(site, record)
+        counts[outcome] += 1
+        if outcome != "imported":
+            continue
+        if record.get("tile") is None:
+            # Update the image_focal_points catalog metadata.
+            to_reindex[record["uid"]] = obj
+        pending += 1
+        if pending >= commit_every:
+            reindex(to_reindex)
+            transaction.commit()
+            pending = 0
+    reindex(to_reindex)
+    transaction.commit()
+    return counts
+
+
+def reindex(objects):
+    for obj in objects.values():
+        # Any index will do: the metadata is updated as well.
+        obj.reindexObject(idxs=["UID"])
+    objects.clear()
+
+
+def format_counts(counts):
+    return ", ".join(f"{name}: {count}" for name, count in sorted(counts.items()))
+
+
+class ExportFocalPoints(BrowserView):
+    """Stream the focal points of all image fields as JSON Lines."""
+
+    def __call__(self):
+        response = self.request.response
+        response.setHeader("Content-Type", "application/x-ndjson")
+        response.setHeader(
+            "Content-Disposition", 'attachment; filename="focalpoints.jsonl"'
+        )
+        for line in export_focal_points(self.context):
+            response.write(line.encode("utf-8"))
+        return b""
+
+
+class ImportFocalPoints(BrowserView):
+    """Import focal points from the JSON Lines file in the 'file' upload."""
+
+    def __call__(self):
+        if self.request.method != "POST":
+            return "POST a JSON Lines file as 'file'."
+        upload = self.request.form.get("file")
+        if upload is None:
+            return "No file."
+        alsoProvides(self.request, IDisableCSRFProtection)
+        counts = import_focal_points(self.context, upload)
+        self.request.response.setHeader("Content-Type", "text/plain")
+        return format_counts(counts)
+
+
+def get_site(zope_conf, site_id):
+    """Start Zope with this configuration and return the site."""
+    from Testing.makerequest import makerequest
+    from zope.component.hooks import setSite
+    from zope.globalrequest import setRequest
+    from Zope2.Startup.run import configure_wsgi
+
+    import Zope2
+
+    configure_wsgi(zope_conf)
+    app = makerequest(Zope2.app())
+    setRequest(app.REQUEST)
+    site = app.unrestrictedTraverse(site_id)
+    setSite(site)
+    return site
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export and import focal points as JSON Lines."
+    )
+    parser.add_argument("--zope-conf", required=True, help="Path to zope.conf.")
+    parser.add_argument("--site", default="Plone", help="Path of the Plone site.")
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("path", help="JSON Lines file.  Use - for stdout/stdin.")
+    options = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    site = get_site(options.zope_conf, options.site)
+    if options.action == "export":
+        output = sys.stdout if options.path == "-" else open(options.path, "w")
+        try:
+            for line in export_focal_points(site):
+                output.write(line)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        return
+    lines = sys.stdin if options.path == "-" else open(options.path)
+    try:
+        counts = import_focal_points(site, lines)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    print(format_counts(counts))
+
+
+if __name__ == "__main__":
+    main()